@@ -0,0 +1,193 @@
+"""
+BracketHighlighter.
+
+Copyright (c) 2013 - 2017 Isaac Muse <isaacmuse@gmail.com>
+License: MIT
+
+Buffer snapshots shared between selections and matches.
+"""
+import sublime
+import threading
+from collections import OrderedDict
+from . import bh_scopes
+
+BH_SNAPSHOT_CACHE_SIZE = 4
+
+snapshots = OrderedDict()
+snapshot_lock = threading.Lock()
+# Bumped when a buffer's scopes may have changed without the buffer changing
+scope_generations = {}
+# Functions that discard what plugins keep per buffer, by name
+buffer_discards = {}
+
+
+class BufferSnapshot(object):
+    """A copy of a buffer's text at a specific change count."""
+
+    def __init__(self, view):
+        """Copy the buffer of the given view."""
+
+        self.buffer_id = view.buffer_id()
+        self.change_count = view.change_count()
+        self.text = view.substr(sublime.Region(0, view.size()))
+        # Scopes of the buffer, sampled as they are needed,
+        # and the syntax and scope generation they were sampled with
+        self.scope_map = None
+        self.scope_key = None
+
+    def is_current(self, view):
+        """Check if the snapshot still reflects the view's buffer."""
+
+        return self.buffer_id == view.buffer_id() and self.change_count == view.change_count()
+
+    def get_scope_map(self, view):
+        """
+        Get the scopes of the buffer.
+
+        Scopes are sampled again if the syntax has changed, or if the scopes
+        may have been reparsed, since they were first sampled.
+        """
+
+        key = get_scope_key(view)
+        if self.scope_map is None or self.scope_key != key:
+            self.scope_map = bh_scopes.ScopeMap(view, self.change_count)
+            self.scope_key = key
+        return self.scope_map
+
+
+def get_snapshot(view):
+    """
+    Get the buffer snapshot for the view.
+
+    The snapshot is only rebuilt if the buffer has changed since the last request,
+    so every selection, plugin hook, and later match share the same copy.
+    A snapshot view always gets the snapshot it was made from.
+    """
+
+    if isinstance(view, SnapshotView):
+        return view.snapshot
+
+    buffer_id = view.buffer_id()
+    with snapshot_lock:
+        snapshot = snapshots.get(buffer_id)
+        if snapshot is None or snapshot.change_count != view.change_count():
+            snapshot = BufferSnapshot(view)
+            snapshots[buffer_id] = snapshot
+            while len(snapshots) > BH_SNAPSHOT_CACHE_SIZE:
+                snapshots.popitem(last=False)
+        snapshots.move_to_end(buffer_id)
+    return snapshot
+
+
+def get_scope_key(view):
+    """Get the syntax and scope generation of the view's buffer, scopes sampled under another key may be stale."""
+
+    return (view.settings().get('syntax'), scope_generations.get(view.buffer_id(), 0))
+
+
+def invalidate_scopes(buffer_id):
+    """Sample the buffer's scopes again as they may have changed without the buffer changing."""
+
+    scope_generations[buffer_id] = scope_generations.get(buffer_id, 0) + 1
+
+
+def discard_snapshot(buffer_id):
+    """Discard the snapshot of a buffer."""
+
+    with snapshot_lock:
+        snapshots.pop(buffer_id, None)
+    scope_generations.pop(buffer_id, None)
+
+
+def add_buffer_discard(name, discard):
+    """
+    Register a function that discards what a plugin keeps for a buffer, it is called with the buffer's id.
+
+    Plugins are loaded again when the rules are reloaded, so registering under the same name replaces the function.
+    """
+
+    buffer_discards[name] = discard
+
+
+def discard_buffer(buffer_id):
+    """Discard what plugins keep for a buffer that has closed."""
+
+    for discard in list(buffer_discards.values()):
+        discard(buffer_id)
+
+
+def clear_snapshots():
+    """Discard all snapshots."""
+
+    with snapshot_lock:
+        snapshots.clear()
+    scope_generations.clear()
+
+
+class SnapshotView(object):
+    """
+    A view whose text, scopes, and selections come from a snapshot.
+
+    This allows matching to be done off the main thread without the buffer
+    changing underneath it.  Anything else is passed through to the real view.
+
+    The view has its own token indexes and scope map, so a match off the
+    main thread never changes the ones the main thread uses.
+    """
+
+    def __init__(self, view, snapshot, scope_map, sels, token_indexes):
+        """Wrap the view."""
+
+        self.view = view
+        self.snapshot = snapshot
+        self.scope_map = scope_map
+        self.sels = sels
+        self.token_indexes = token_indexes
+
+    def __getattr__(self, name):
+        """Pass everything else through to the view."""
+
+        return getattr(self.view, name)
+
+    def buffer_id(self):
+        """Get the buffer id of the snapshot."""
+
+        return self.snapshot.buffer_id
+
+    def change_count(self):
+        """Get the change count of the snapshot."""
+
+        return self.snapshot.change_count
+
+    def sel(self):
+        """Get the selections at the time of the snapshot."""
+
+        return self.sels
+
+    def size(self):
+        """Get the size of the snapshot."""
+
+        return len(self.snapshot.text)
+
+    def substr(self, x):
+        """Get the text of a region or the character at a point from the snapshot."""
+
+        text = self.snapshot.text
+        if isinstance(x, sublime.Region):
+            return text[x.begin():x.end()]
+        return text[x] if 0 <= x < len(text) else '\x00'
+
+    def scope_name(self, pt):
+        """Get the scope name at the given point."""
+
+        return self.scope_map.scope_name(pt)
+
+    def score_selector(self, pt, selector):
+        """Score the selector against the scope at the given point."""
+
+        return self.scope_map.score_selector(pt, selector)
+
+    def match_selector(self, pt, selector):
+        """Check if the selector matches the scope at the given point."""
+
+        return self.scope_map.match_selector(pt, selector)
@@ -7,12 +7,17 @@ License: MIT
 import sublime
 import sublime_plugin
 from os.path import basename, splitext
-from time import time, sleep
+from time import time
 import threading
-from queue import Queue
 import traceback
+import json
 from . import bh_plugin
+from . import bh_buffer
 from . import bh_search
+from . import bh_tokens
+from . import bh_pairs
+from . import bh_scopes
+from . import bh_state
 from . import bh_regions
 from . import bh_rules
 from . import bh_popup
@@ -22,12 +27,20 @@ if 'bh_thread' not in globals():
     bh_thread = None
 
 bh_match = None
+bh_key_cores = {}
 
 BH_MATCH_TYPE_NONE = 0
 BH_MATCH_TYPE_SELECTION = 1
 BH_MATCH_TYPE_EDIT = 2
 GLOBAL_ENABLE = True
 HIGH_VISIBILITY = False
+# Text commands that only move the selections, and so can't change the scopes of the buffer
+BH_SELECTION_COMMANDS = frozenset(
+    [
+        'move', 'move_to', 'drag_select', 'expand_selection', 'single_selection',
+        'select_all', 'select_lines', 'scroll_lines'
+    ]
+)
 
 
 ####################
@@ -37,6 +50,7 @@ class BhCore(object):
     """Bracket matching class."""
 
     plugin_reload = False
+    generation = 0
 
     ####################
     # Match Setup
@@ -101,6 +115,16 @@ class BhCore(object):
         # Initialize selection parameters
         self.use_selection_threshold = True
         self.selection_threshold = int(self.settings.get("search_threshold", 5000))
+        self.time_budget = int(self.settings.get("match_time_budget", 0)) / 1000.0
+        self.viewport_first = bool(self.settings.get("viewport_first_matching", False))
+        self.pending_sels = []
+        self.adaptive_threshold = bool(self.settings.get("adaptive_search_threshold", False))
+        self.adaptive_timeout = int(self.settings.get("adaptive_search_timeout", 50)) / 1000.0
+        self.adaptive_deadline = None
+        self.hook_results = None
+        self.use_pair_tree = bool(self.settings.get("bracket_pair_tree", False))
+        self.pair_tree_timeout = int(self.settings.get("bracket_pair_tree_timeout", 50)) / 1000.0
+        self.background = bool(self.settings.get("background_matching", False))
         self.loaded_modules = set([])
 
         # Initialize plugin
@@ -124,11 +148,15 @@ class BhCore(object):
 
         loaded_modules = self.loaded_modules.copy()
 
-        self.rules.load_rules(
+        reloaded = self.rules.load_rules(
             language,
             loaded_modules
         )
 
+        # Key commands reload the bracket plugin modules, so the main matcher must reload as well
+        if reloaded and self.keycommand:
+            BhCore.plugin_reload = True
+
     def init_match(self, num_sels):
         """Reset matching settings for the current view's syntax."""
 
@@ -245,6 +273,11 @@ class BhCore(object):
         if not self.rules.check_validate:
             return match
 
+        # Results are remembered while an adaptive search retries with a larger window
+        key = ('validate', b, bracket_type, scope_bracket)
+        if self.hook_results is not None and key in self.hook_results:
+            return self.hook_results[key]
+
         bracket = self.rules.scopes[b.scope]["brackets"][b.type] if scope_bracket else self.rules.brackets[b.type]
         if bracket.validate is not None:
             try:
@@ -265,6 +298,8 @@ class BhCore(object):
                     )
                 except Exception:
                     log("Plugin Bracket Find Error:\n%s" % str(traceback.format_exc()))
+        if self.hook_results is not None:
+            self.hook_results[key] = match
         return match
 
     def compare(self, first, second, scope_bracket=False):
@@ -278,6 +313,10 @@ class BhCore(object):
         if not self.rules.check_compare:
             return match
 
+        key = ('compare', first, second, scope_bracket)
+        if self.hook_results is not None and key in self.hook_results:
+            return self.hook_results[key]
+
         if match:
             if scope_bracket:
                 bracket = self.rules.scopes[first.scope]["brackets"][first.type]
@@ -293,6 +332,8 @@ class BhCore(object):
                     )
             except Exception:
                 log("Plugin Compare Error:\n%s" % str(traceback.format_exc()))
+        if self.hook_results is not None:
+            self.hook_results[key] = match
         return match
 
     def post_match(self, left, right, center, scope_bracket=False):
@@ -369,23 +410,158 @@ class BhCore(object):
         if view is None:
             return
 
+        # Any match that is still running in the background is now stale
+        BhCore.generation += 1
+
         # Ensure nothing else calls BH until done
-        view.settings().set("bracket_highlighter.busy", True)
+        state = bh_state.get_view_state(view.id())
+        state.busy = True
 
         regions_key = "bracket_highlighter.regions"
-        locations_key = "bracket_highlighter.locations"
 
         # Abort if disabled
         if not GLOBAL_ENABLE:
             for region_key in view.settings().get(regions_key, []):
                 view.erase_regions(region_key)
-            view.settings().set(locations_key, {})
+            bh_regions.forget_drawn_regions(view.id())
+            state.busy = False
+            return
+
+        if self.background and not self.keycommand:
+            # Other packages can't see our state, so let them know a match is pending
+            state.background = BhCore.generation
+            view.settings().set("bracket_highlighter.busy", True)
+            self.match_async(view, force_match)
+            return
+
+        try:
+            if self.process(view, force_match):
+                # Highlight, focus, and display lines etc.
+                self.regions.highlight(HIGH_VISIBILITY)
+
+                # Free up BH
+                self.search = None
+                self.view = None
+
+                # Setup thread to do another match to refresh the match
+                if self.refresh_match:
+                    refresh_match(view)
+
+                self.queue_pending(view)
+        finally:
+            state.busy = False
+
+    def match_async(self, view, force_match):
+        """
+        Match brackets in the background.
+
+        The buffer and the scopes around the selections are captured now,
+        and the regions are applied back on the main thread when done.
+        """
+
+        generation = BhCore.generation
+        sels = [sublime.Region(sel.a, sel.b) for sel in view.sel()]
+        points = []
+        for sel in (sels if self.ignore_threshold else sels[:self.auto_selection_threshold]):
+            points.extend((sel.a, sel.b))
+        snapshot_view = bh_buffer.SnapshotView(
+            view,
+            bh_buffer.get_snapshot(view),
+            bh_scopes.sample_windows(view, points, None if self.ignore_threshold else self.selection_threshold),
+            sels,
+            bh_tokens.copy_token_indexes(view.buffer_id())
+        )
+        sublime.set_timeout_async(lambda: self.match_background(snapshot_view, generation, force_match), 0)
+
+    def match_background(self, view, generation, force_match):
+        """
+        Match brackets on the snapshot of a view and send the regions back to the main thread.
+
+        The result is always sent back, even if the match fails, so the view isn't left busy.
+        If the buffer changes before the scopes the match needs are sampled, the match is abandoned,
+        so results mixing the snapshot with scopes of a newer buffer are never kept.
+        """
+
+        update = None
+        refresh = False
+        change_count = view.change_count()
+        try:
+            if generation == BhCore.generation and self.process(view, force_match, generation):
+                update = self.regions.prepare(HIGH_VISIBILITY)
+                refresh = self.refresh_match
+        except bh_scopes.StaleScopes:
+            # The match of the changed buffer will replace it
+            pass
+        finally:
+            self.search = None
+            self.view = None
+            view = view.view
+            sublime.set_timeout(lambda: self.apply_background(view, update, generation, change_count, refresh), 0)
+
+    def apply_background(self, view, update, generation, change_count, refresh):
+        """Apply regions matched in the background, unless the view has changed since."""
+
+        state = bh_state.get_view_state(view.id())
+        if generation == BhCore.generation:
+            # Nothing newer is on its way
+            if update is not None and view.change_count() == change_count:
+                update.apply(view)
+                if refresh:
+                    refresh_match(view)
+                self.queue_pending(view)
+            state.busy = False
+
+        if state.background == generation:
+            # No newer background match is pending for the view
+            state.background = None
             view.settings().set("bracket_highlighter.busy", False)
+
+    def queue_pending(self, view):
+        """Queue the selections that were left for later to be matched a batch at a time."""
+
+        if self.pending_sels:
+            generation = BhCore.generation
+            change_count = view.change_count()
+            sublime.set_timeout(lambda: self.match_pending(view, generation, change_count), 0)
+
+    def match_pending(self, view, generation, change_count):
+        """
+        Match a batch of the selections that were left for later and add their regions.
+
+        Selections that have since been scrolled into view go first.
+        If a newer match has started, the rest are left for it to queue.
+        """
+
+        if generation != BhCore.generation or view.change_count() != change_count or not view.is_valid():
             return
 
-        # Handle key command quirks
-        if self.keycommand:
-            BhCore.plugin_reload = True
+        visible = view.visible_region()
+        pending = (
+            [sel for sel in self.pending_sels if self.is_visible(visible, sel)] +
+            [sel for sel in self.pending_sels if not self.is_visible(visible, sel)]
+        )
+        sels = sorted(pending[:self.auto_selection_threshold], key=lambda sel: sel.begin())
+        self.pending_sels = sorted(pending[self.auto_selection_threshold:], key=lambda sel: sel.begin())
+
+        state = bh_state.get_view_state(view.id())
+        state.busy = True
+        self.view = view
+        try:
+            self.process_sels(view, sels, bh_buffer.get_snapshot(view), generation, False)
+            self.regions.highlight(HIGH_VISIBILITY)
+        finally:
+            self.search = None
+            self.view = None
+            state.busy = False
+
+        self.queue_pending(view)
+
+    def process(self, view, force_match, generation=None):
+        """
+        Match the brackets of the view's selections.
+
+        Returns `False` if there is nothing to highlight or the match was cancelled.
+        """
 
         if not self.keycommand and BhCore.plugin_reload:
             self.setup()
@@ -397,13 +573,17 @@ class BhCore(object):
         sels = view.sel()
         num_sels = len(sels)
 
+        # Match visible selections first if selections are beyond the threshold
+        viewport_first = (
+            self.viewport_first and not self.keycommand and not self.ignore_threshold and
+            not self.regions.alter_select and num_sels > self.auto_selection_threshold
+        )
+
         # Abort if selections are beyond the threshold and "kill" is enabled
-        if not self.ignore_threshold and self.kill_highlight_on_threshold:
+        if not self.ignore_threshold and self.kill_highlight_on_threshold and not viewport_first:
             if self.use_selection_threshold and num_sels > self.auto_selection_threshold:
                 self.regions.reset(view, num_sels)
-                self.regions.highlight(HIGH_VISIBILITY)
-                view.settings().set("bracket_highlighter.busy", False)
-                return
+                return True
 
         # Initialize
         if self.unique(sels) or force_match:
@@ -412,51 +592,89 @@ class BhCore(object):
 
             # Nothing to search for
             if not self.rules.enabled:
-                view.settings().set("bracket_highlighter.busy", False)
-                return
-
-            # Process selections.
-            multi_select_count = 0
-            for sel in sels:
-                if not self.ignore_threshold and multi_select_count >= self.auto_selection_threshold:
-                    # Exceeded threshold, only what must be done
-                    # and break
-                    if not self.regions.alter_select:
-                        break
-                    self.regions.store_sel([sel])
-                    continue
+                return False
 
-                # Sub-search guard for recursive matching of scopes
-                self.recursive_guard = False
+            # Copy the buffer once and share it with every selection.
+            snapshot = bh_buffer.get_snapshot(view)
 
-                # Prepare for search
-                self.bracket_style = None
-                self.search = bh_search.Search(
-                    view, self.rules,
-                    sel, self.selection_threshold if not self.ignore_threshold else None
-                )
+            capped = True
+            self.pending_sels = []
+            if viewport_first:
+                # Match what can be seen now, and leave the rest for later.
+                visible = view.visible_region()
+                self.pending_sels = [sel for sel in sels if not self.is_visible(visible, sel)]
+                sels = [sel for sel in sels if self.is_visible(visible, sel)]
+                capped = False
 
-                # Find and match
-                if not self.find_scopes(sel):
-                    self.sub_search_mode = False
-                    self.find_matches(sel)
-                multi_select_count += 1
+            return self.process_sels(view, sels, snapshot, generation, capped)
+        return True
+
+    @staticmethod
+    def is_visible(visible, sel):
+        """Check if the cursor of the selection is within the visible region."""
+
+        return visible.begin() <= sel.b <= visible.end()
+
+    def process_sels(self, view, sels, snapshot, generation, capped=True):
+        """
+        Match the brackets of each selection.
+
+        If the match runs out of time, the selection being matched is marked as unresolved
+        and the remaining selections are skipped.
+        """
 
-        # Highlight, focus, and display lines etc.
-        self.regions.highlight(HIGH_VISIBILITY)
+        # Adaptive searches of every selection share one time limit.
+        self.adaptive_deadline = None
+
+        # Shortcuts and commands are always allowed to finish.
+        budget = not self.keycommand and self.time_budget > 0
+        bh_plugin.set_deadline(time() + self.time_budget if budget else None)
+        try:
+            return self.match_sels(view, sels, snapshot, generation, capped)
+        finally:
+            bh_plugin.set_deadline(None)
+
+    def match_sels(self, view, sels, snapshot, generation, capped):
+        """Match the brackets of each selection, stopping at the selection threshold if capped."""
+
+        # Selections are in buffer order, so each one's scan picks up where the last one left off
+        # in the buffer's token index, and neighboring cursors can share a pair.
+        self.shared_pair = None
+        multi_select_count = 0
+        for sel in sels:
+            if generation is not None and generation != BhCore.generation:
+                # A newer match has been requested
+                return False
+
+            if capped and not self.ignore_threshold and multi_select_count >= self.auto_selection_threshold:
+                # Exceeded threshold, only what must be done
+                # and break
+                if not self.regions.alter_select:
+                    break
+                self.regions.store_sel([sel])
+                continue
 
-        # Free up BH
-        self.search = None
-        self.view = None
+            # Sub-search guard for recursive matching of scopes
+            self.recursive_guard = False
 
-        # Setup thread to do another match to refresh the match
-        if self.refresh_match:
-            start_task()
-            bh_thread.type = BH_MATCH_TYPE_SELECTION
-            bh_thread.modified = True
-            bh_thread.time = time()
+            # Prepare for search
+            self.bracket_style = None
+            self.search = bh_search.Search(
+                view, self.rules,
+                sel, self.selection_threshold if not self.ignore_threshold else None,
+                snapshot
+            )
 
-        view.settings().set("bracket_highlighter.busy", False)
+            # Find and match
+            try:
+                if not self.find_scopes(sel):
+                    self.sub_search_mode = False
+                    self.find_matches(sel)
+            except bh_plugin.MatchTimeout:
+                self.regions.save_unresolved_regions(sel, [sublime.Region(sel.a, sel.b)])
+                break
+            multi_select_count += 1
+        return True
 
     def sub_search(self, sel, scope=None):
         """Search a scope bracket match for brackets within."""
@@ -507,9 +725,19 @@ class BhCore(object):
         """Find bracket matches."""
 
         bracket = None
-        left, right, adj_scope = self.match_brackets(sel)
+        center = sel.b
+        if self.is_shared_pair(center):
+            # With no brackets between this cursor and the last one, both resolve to the same pair,
+            # and it has already been highlighted.
+            return
+
+        if self.adaptive_threshold:
+            left, right, adj_scope = self.match_adaptive(sel)
+        else:
+            left, right, adj_scope = self.match_brackets(sel)
         if adj_scope:
             return
+        self.shared_pair = (center, left, right) if left is not None and right is not None else None
 
         regions = [sublime.Region(sel.a, sel.b)]
 
@@ -523,6 +751,22 @@ class BhCore(object):
         if not self.regions.save_regions(left, right, regions, self.bracket_style, HIGH_VISIBILITY):
             self.regions.store_sel(regions)
 
+    def is_shared_pair(self, center):
+        """
+        Check if the cursor resolves to the pair the last cursor resolved to.
+
+        Only a resolved pair that is within this cursor's search window is shared,
+        and only the tokens between the cursors need to be checked.
+        """
+
+        if self.shared_pair is None or self.regions.alter_select:
+            return False
+        shared_center, left, right = self.shared_pair
+        window_start, window_end = self.search.search_window
+        if not (window_start <= shared_center <= window_end and window_start <= left.begin and right.end <= window_end):
+            return False
+        return not self.search.touches_tokens(min(shared_center, center), max(shared_center, center))
+
     def match_scope_brackets(self, sel, adj_dir):
         """
         Perform match for scope brackets.
@@ -550,11 +794,10 @@ class BhCore(object):
         for s in self.rules.scopes:
             scope = s["name"]
             # Identify if the cursor is in a scope with bracket definitions
-            try:
-                scope_search = self.search.new_scope_search(
-                    center, before_center, scope, adj_dir
-                )
-            except Exception:
+            scope_search = self.search.new_scope_search(
+                center, before_center, scope, adj_dir
+            )
+            if scope_search is None:
                 scope_count += 1
                 continue
 
@@ -628,8 +871,110 @@ class BhCore(object):
         left, right = self.post_match(left, right, center, scope_bracket=True)
         return left, right, bracket, False
 
-    def match_brackets(self, sel, scope=None):
-        """Regex bracket matching."""
+    def get_pair_tree(self):
+        """
+        Get the bracket pair tree of the buffer, building it if the buffer has changed.
+
+        Returns `None` if the tree can't be built within the time limit.  The buffer
+        is then searched outward instead until it shrinks below the size that failed.
+        """
+
+        snapshot = self.search.snapshot
+        tree = bh_pairs.get_pair_tree(snapshot.buffer_id, snapshot.change_count, self.rules)
+        if tree is not None:
+            return tree
+        size = len(snapshot.text)
+        if bh_pairs.is_oversized(snapshot.buffer_id, size):
+            return None
+
+        tree = bh_pairs.PairTree(snapshot.buffer_id, snapshot.change_count, self.rules)
+        deadline = bh_plugin.get_deadline()
+        limit = time() + self.pair_tree_timeout
+        bh_plugin.set_deadline(limit if deadline is None else min(limit, deadline))
+        try:
+            tree.build(self.search.get_brackets(), self.validate, self.compare)
+        except bh_plugin.MatchTimeout:
+            if deadline is not None and time() > deadline:
+                # The match itself is out of time
+                raise
+            bh_pairs.set_oversized(snapshot.buffer_id, size)
+            return None
+        finally:
+            bh_plugin.set_deadline(deadline)
+        bh_pairs.set_pair_tree(tree)
+        return tree
+
+    def match_pairs(self, sel, tree, retry=False):
+        """Bracket matching with the buffer's pair tree."""
+
+        center = sel.b
+        if self.rules.outside_adj and not tree.touches(center) and not self.recursive_guard and not retry:
+            if self.find_scopes(sel, bh_search.BH_ADJACENT_RIGHT):
+                return None, None, True
+            self.sub_search_mode = False
+
+        left, right = tree.find(center, self.search.search_window, self.rules.outside_adj, self.rules.block_cursor)
+
+        if self.adj_only:
+            if self.rules.block_cursor:
+                left, right = self.block_adjacent_check(left, right, center)
+            else:
+                left, right = self.adjacent_check(left, right, center)
+
+        left, right = self.post_match(left, right, center)
+        return left, right, False
+
+    def match_adaptive(self, sel):
+        """
+        Match brackets, growing the search window until a pair is found.
+
+        The window doubles in size until a pair is found, no pair can be found by growing it,
+        or the time limit shared by every selection of the match runs out.  Tokens scanned,
+        and plugin `validate` and `compare` results found, by earlier attempts are reused.
+        """
+
+        if self.adaptive_deadline is None:
+            self.adaptive_deadline = time() + self.adaptive_timeout
+        self.hook_results = {}
+        try:
+            left, right, adj_scope = self.match_brackets(sel)
+            while (
+                not adj_scope and self.can_grow(left, right) and
+                time() < self.adaptive_deadline and
+                self.search.grow_search_window()
+            ):
+                left, right, adj_scope = self.match_brackets(sel, retry=True)
+        finally:
+            self.hook_results = None
+        return left, right, adj_scope
+
+    def can_grow(self, left, right):
+        """
+        Check if growing the search window could still find a pair.
+
+        A missing bracket can't be found if the search already reached that end of the buffer.
+        """
+
+        window_start, window_end = self.search.search_window
+        if left is not None and right is not None:
+            return False
+        if left is None and window_start <= 0:
+            return False
+        if right is None and window_end >= self.search.view_size:
+            return False
+        return True
+
+    def match_brackets(self, sel, scope=None, retry=False):
+        """
+        Regex bracket matching.
+
+        Scope brackets adjacent to the cursor have already been checked when retrying with a larger window.
+        """
+
+        if self.use_pair_tree and scope is None and not self.sub_search_mode:
+            tree = self.get_pair_tree()
+            if tree is not None:
+                return self.match_pairs(sel, tree, retry)
 
         center = sel.b
         left = None
@@ -638,11 +983,12 @@ class BhCore(object):
         bracket_search = self.search.new_bracket_search(
             center, self.sub_search_mode, scope
         )
-        if self.rules.outside_adj and not bracket_search.touch_right and not self.recursive_guard:
+        if self.rules.outside_adj and not bracket_search.touch_right and not self.recursive_guard and not retry:
             if self.find_scopes(sel, bh_search.BH_ADJACENT_RIGHT):
                 return None, None, True
             self.sub_search_mode = False
         for o in bracket_search.get_open(bh_search.BH_SEARCH_LEFT):
+            bh_plugin.check_deadline()
             if not self.validate(o, bh_search.BH_SEARCH_OPEN):
                 continue
             if len(stack) and bracket_search.is_done(bh_search.BH_SEARCH_CLOSE):
@@ -650,6 +996,7 @@ class BhCore(object):
                     stack.pop()
                     continue
             for c in bracket_search.get_close(bh_search.BH_SEARCH_LEFT):
+                bh_plugin.check_deadline()
                 if not self.validate(c, bh_search.BH_SEARCH_CLOSE):
                     continue
                 if o.end <= c.begin:
@@ -673,6 +1020,7 @@ class BhCore(object):
         # Grab each closest closing right side bracket and attempt to match it.
         # If the closing bracket cannot be matched, select it.
         for c in bracket_search.get_close(bh_search.BH_SEARCH_RIGHT):
+            bh_plugin.check_deadline()
             if not self.validate(c, bh_search.BH_SEARCH_CLOSE):
                 continue
             if len(stack) and bracket_search.is_done(bh_search.BH_SEARCH_OPEN):
@@ -680,6 +1028,7 @@ class BhCore(object):
                     stack.pop()
                     continue
             for o in bracket_search.get_open(bh_search.BH_SEARCH_RIGHT):
+                bh_plugin.check_deadline()
                 if not self.validate(o, bh_search.BH_SEARCH_OPEN):
                     continue
                 if o.end <= c.begin:
@@ -771,8 +1120,7 @@ class BhOffscreenPopupCommand(sublime_plugin.TextCommand):
 
         # Find other bracket
         region = None
-        index = None
-        unmatched = False
+        icon = None
         between = None
 
         # Ensure only 1 point is set
@@ -793,39 +1141,14 @@ class BhOffscreenPopupCommand(sublime_plugin.TextCommand):
 
         # Get relative bracket regions for point
         if point is not None:
-            locations_key = 'bracket_highlighter.locations'
-            locations = self.view.settings().get(locations_key, {})
-            for k, v in locations.get('unmatched', {}).items():
-                if v[0] <= point <= v[1]:
-                    unmatched = True
-                    break
-            if not unmatched:
-                for k, v in locations.get('open', {}).items():
-                    if v[0] <= point <= v[1]:
-                        index = k
-                        between = None
-                        break
-                    elif v[0] <= point <= locations.get('close', {}).get(k)[1]:
-                        between = k
-
-                if index is None:
-                    for k, v in locations.get('close', {}).items():
-                        if v[0] <= point <= v[1]:
-                            index = k
-                            between = None
-                            break
-                    if index is not None:
-                        region = locations.get('open', {}).get(index)
-                        icon = locations.get('icon', {}).get(index)
-                else:
-                    region = locations.get('close', {}).get(index)
-                    icon = locations.get('icon', {}).get(index)
-
-            if between:
-                region = locations.get('open', {}).get(between)
-                region2 = locations.get('close', {}).get(between)
-                icon = locations.get('icon', {}).get(between)
-                bh_popup.BhOffscreenPopup().show_popup_between(self.view, point, region, region2, icon)
+            locations = bh_state.get_view_state(self.view.id()).locations
+            if not locations.is_unmatched(point):
+                region, icon = locations.get_partner(point)
+                if region is None:
+                    between = locations.get_between(point)
+
+            if between is not None:
+                bh_popup.BhOffscreenPopup().show_popup_between(self.view, point, *between)
             elif region is not None:
                 bh_popup.BhOffscreenPopup().show_popup(self.view, point, region, icon)
             elif not no_threshold:
@@ -886,16 +1209,15 @@ class BhKeyCommand(sublime_plugin.TextCommand):
 
         # Override events
         bh_thread.ignore_all = True
-        bh_thread.modified = False
-        self.bh = BhCore(
+        bh_thread.cancel(self.view)
+        self.bh = get_key_core(
             threshold,
             lines,
             adjacent,
             no_outside_adj,
             no_block_mode,
             ignore,
-            plugin,
-            True
+            plugin
         )
         self.execute()
 
@@ -984,6 +1306,7 @@ class BhListenerCommand(sublime_plugin.EventListener):
     def on_hover(self, view, point, hover_zone):
         """Show popup indicating where other offscreen bracket is located."""
 
+        bh_regions.check_clipped_regions(view)
         settings = sublime.load_settings('bh_core.sublime-settings')
         if (
             GLOBAL_ENABLE and bh_popup.HOVER_SUPPORT and
@@ -992,31 +1315,13 @@ class BhListenerCommand(sublime_plugin.EventListener):
         ):
             # Find other bracket
             region = None
-            index = None
+            icon = None
             unmatched = False
             if hover_zone == sublime.HOVER_TEXT:
-                locations_key = 'bracket_highlighter.locations'
-                locations = view.settings().get(locations_key, {})
-                for k, v in locations.get('unmatched', {}).items():
-                    if v[0] <= point <= v[1]:
-                        unmatched = True
-                        break
+                locations = bh_state.get_view_state(view.id()).locations
+                unmatched = locations.is_unmatched(point)
                 if not unmatched:
-                    for k, v in locations.get('open', {}).items():
-                        if v[0] <= point <= v[1]:
-                            index = k
-                            break
-                    if index is None:
-                        for k, v in locations.get('close', {}).items():
-                            if v[0] <= point <= v[1]:
-                                index = k
-                                break
-                        if index is not None:
-                            region = locations.get('open', {}).get(index)
-                            icon = locations.get('icon', {}).get(index)
-                    else:
-                        region = locations.get('close', {}).get(index)
-                        icon = locations.get('icon', {}).get(index)
+                    region, icon = locations.get_partner(point)
 
             # Show other bracket text
             if unmatched:
@@ -1029,20 +1334,34 @@ class BhListenerCommand(sublime_plugin.EventListener):
 
         if self.ignore_event(view):
             return
-        bh_thread.type = BH_MATCH_TYPE_SELECTION
-        bh_thread.view = view
-        sublime.set_timeout(bh_thread.payload, 0)
+        bh_thread.request(view, BH_MATCH_TYPE_SELECTION, 0)
 
     def on_modified(self, view):
         """Update highlighted brackets when the text changes."""
 
         if self.ignore_event(view):
             return
-        start_task()
-        bh_thread.type = BH_MATCH_TYPE_EDIT
-        bh_thread.modified = True
-        bh_thread.view = view
-        bh_thread.time = time()
+        bh_thread.request(view, BH_MATCH_TYPE_EDIT)
+
+    def on_pre_close(self, view):
+        """
+        Release the buffer snapshot, token index, and trees of a buffer whose last view is closing.
+
+        Other views of the buffer, such as clones, keep using them.
+        """
+
+        if any(other.id() != view.id() for other in view.buffer().views()):
+            return
+        buffer_id = view.buffer_id()
+        bh_buffer.discard_snapshot(buffer_id)
+        bh_tokens.discard_token_index(buffer_id)
+        bh_pairs.discard_pair_tree(buffer_id)
+        bh_buffer.discard_buffer(buffer_id)
+
+    def on_close(self, view):
+        """Discard the match state of a view that has closed."""
+
+        bh_state.discard_view_state(view.id())
 
     def clear_disabled(self, view):
         """Clear disabled regions."""
@@ -1060,34 +1379,40 @@ class BhListenerCommand(sublime_plugin.EventListener):
             if settings.get('bracket_highlighter.regions'):
                 for region_key in view.settings().get("bracket_highlighter.regions", []):
                     view.erase_regions(region_key)
+                bh_regions.forget_drawn_regions(view.id())
 
     def on_activated(self, view):
         """Highlight brackets when the view gains focus again."""
 
+        # The buffer may have been reparsed while the view was in the background
+        bh_buffer.invalidate_scopes(view.buffer_id())
+        bh_regions.check_clipped_regions(view)
+
         if bh_thread is not None:
             self.clear_disabled(view)
 
         if self.ignore_event(view):
             return
-        bh_thread.type = BH_MATCH_TYPE_SELECTION
-        bh_thread.view = view
-        sublime.set_timeout(bh_thread.payload, 0)
+        bh_thread.request(view, BH_MATCH_TYPE_SELECTION, 0)
+
+    def on_post_text_command(self, view, command_name, args):
+        """
+        Sample the scopes again after commands that may have changed them without changing the buffer.
+
+        Commands can also scroll the view, so clipped regions are checked as well.
+        """
+
+        if command_name not in BH_SELECTION_COMMANDS:
+            bh_buffer.invalidate_scopes(view.buffer_id())
+        bh_regions.check_clipped_regions(view)
 
     def on_selection_modified(self, view):
         """Highlight brackets when the selections change."""
 
+        bh_regions.check_clipped_regions(view)
         if self.ignore_event(view):
             return
-        if bh_thread.type != BH_MATCH_TYPE_EDIT:
-            bh_thread.type = BH_MATCH_TYPE_SELECTION
-        now = time()
-        bh_thread.view = view
-        if now - bh_thread.time > bh_thread.wait_time:
-            sublime.set_timeout(bh_thread.payload, 0)
-        else:
-            start_task()
-            bh_thread.modified = True
-            bh_thread.time = now
+        bh_thread.request(view, BH_MATCH_TYPE_SELECTION)
 
     def ignore_event(self, view):
         """
@@ -1108,70 +1433,167 @@ class BhListenerCommand(sublime_plugin.EventListener):
         )
 
 
+class BhTextChangeListener(sublime_plugin.TextChangeListener):
+    """Keep the bracket token index in sync with buffer edits."""
+
+    def on_text_changed(self, changes):
+        """Shift and invalidate indexed tokens affected by the changes."""
+
+        view = self.buffer.primary_view()
+        if view is not None:
+            bh_tokens.apply_changes(self.buffer.id(), changes, view.change_count())
+
+
 class BhThread(threading.Thread):
-    """BH threading."""
+    """
+    Schedule matches.
+
+    Match requests are debounced per view, and requests that come in before
+    a view's match is due are merged into one.  The thread sleeps until the
+    next match is due, or until it is woken by a new request.
+    """
 
     def __init__(self):
         """Setup the thread."""
 
-        self.reset()
-        self.queue = Queue()
-        self.view = None
         threading.Thread.__init__(self)
+        self.daemon = True
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.abort = False
+        self.ignore_all = False
+        self.time = time()
+        self.load_delays()
 
-    def reset(self):
-        """Reset the thread variables."""
+    def load_delays(self):
+        """Load how long to wait before matching after each kind of event, they are reloaded when settings change."""
 
-        self.wait_time = 0.12
-        self.time = time()
-        self.queue = Queue()
-        self.modified = False
-        self.type = BH_MATCH_TYPE_SELECTION
-        self.ignore_all = False
-        self.abort = False
+        settings = sublime.load_settings("bh_core.sublime-settings")
+        self.delays = {
+            BH_MATCH_TYPE_EDIT: max(0, int(settings.get("edit_match_delay", 120))) / 1000.0,
+            BH_MATCH_TYPE_SELECTION: max(0, int(settings.get("selection_match_delay", 120))) / 1000.0
+        }
+
+    def get_delay(self, match_type):
+        """Get how long to wait before matching after an event."""
+
+        return self.delays[BH_MATCH_TYPE_EDIT if match_type == BH_MATCH_TYPE_EDIT else BH_MATCH_TYPE_SELECTION]
+
+    def request(self, view, match_type, delay=None):
+        """
+        Request a match for the view.
+
+        Selection changes that come in after the view has been idle are matched right away.
+        Otherwise, the match is pushed back until events stop coming in for the delay.
+        """
+
+        now = time()
+        wait_time = self.get_delay(match_type)
+        with self.condition:
+            entry = self.pending.get(view.id())
+            if delay is None:
+                if match_type == BH_MATCH_TYPE_SELECTION and entry is None and now - self.time > wait_time:
+                    delay = 0
+                else:
+                    delay = wait_time
+            if entry is not None and entry[1] == BH_MATCH_TYPE_EDIT:
+                # A pending edit needs a full match
+                match_type = BH_MATCH_TYPE_EDIT
+            self.time = now
+            if delay == 0:
+                self.pending.pop(view.id(), None)
+                self.dispatch(view, match_type)
+            else:
+                self.pending[view.id()] = (view, match_type, now + delay)
+                self.condition.notify()
+
+    def cancel(self, view=None):
+        """Cancel pending matches for a view, or for all views."""
+
+        with self.condition:
+            if view is None:
+                self.pending.clear()
+            else:
+                self.pending.pop(view.id(), None)
+
+    def dispatch(self, view, match_type):
+        """Send the match to the main thread."""
+
+        sublime.set_timeout(lambda: self.payload(view, match_type), 0)
 
-    def payload(self):
-        """Code to run."""
+    def payload(self, view, match_type):
+        """Run the match on the main thread."""
 
-        self.modified = False
         self.ignore_all = True
-        if bh_match is not None and self.view is not None:
-            bh_match(self.view, self.type == BH_MATCH_TYPE_EDIT)
-        self.view = None
+        if bh_match is not None and view.is_valid():
+            bh_match(view, match_type == BH_MATCH_TYPE_EDIT)
         self.ignore_all = False
         self.time = time()
 
     def kill(self):
         """Kill thread."""
 
-        self.abort = True
-        self.queue.put(True)
-        while self.is_alive():
-            pass
-        self.reset()
+        with self.condition:
+            self.abort = True
+            self.pending.clear()
+            self.condition.notify()
+        if self.is_alive():
+            self.join()
 
     def run(self):
         """Thread loop."""
 
-        task = False
-        while not self.abort:
-            task = self.queue.get()
-            while task and not self.abort:
-                if self.modified is True and time() - self.time > self.wait_time:
-                    sublime.set_timeout(self.payload, 0)
-                    task = False
-                sleep(0.5)
+        with self.condition:
+            while not self.abort:
+                now = time()
+                due = None
+                for key, (view, match_type, when) in list(self.pending.items()):
+                    if when <= now:
+                        del self.pending[key]
+                        self.dispatch(view, match_type)
+                    elif due is None or when < due:
+                        due = when
+                self.condition.wait(None if due is None else due - now)
 
 
 ####################
 # Loading
 ####################
 
-def start_task():
-    """Start task."""
+def refresh_match(view):
+    """Do another match to refresh the last one."""
+
+    if bh_thread is not None:
+        bh_thread.request(view, BH_MATCH_TYPE_SELECTION, bh_thread.get_delay(BH_MATCH_TYPE_SELECTION))
+
+
+def get_key_core(*args):
+    """
+    Get the matcher for a key command.
+
+    Matchers are cached by the command's options and are dropped when the settings change.
+    """
+
+    key = json.dumps(args, sort_keys=True, default=str)
+    bh = bh_key_cores.get(key)
+    if bh is None:
+        bh = BhCore(*args, keycommand=True)
+        bh_key_cores[key] = bh
+    return bh
+
+
+def clear_key_cores():
+    """Clear the cached key command matchers."""
 
-    if bh_thread.is_alive():
-        bh_thread.queue.put(True)
+    bh_key_cores.clear()
+
+
+def reload_settings():
+    """Drop the key command matchers and reload the match delays when the settings change."""
+
+    clear_key_cores()
+    if bh_thread is not None:
+        bh_thread.load_delays()
 
 
 def init_bh_match():
@@ -1196,9 +1618,13 @@ def plugin_loaded():
     init_bh_match()
 
     global HIGH_VISIBILITY
-    if sublime.load_settings("bh_core.sublime-settings").get('high_visibility_enabled_by_default', False):
+    settings = sublime.load_settings("bh_core.sublime-settings")
+    if settings.get('high_visibility_enabled_by_default', False):
         HIGH_VISIBILITY = True
 
+    settings.clear_on_change('key_reload')
+    settings.add_on_change('key_reload', reload_settings)
+
     if bh_thread is not None:
         bh_thread.kill()
     bh_thread = BhThread()
@@ -1209,4 +1635,9 @@ def plugin_unloaded():
     """Tear down plugin."""
 
     bh_thread.kill()
+    sublime.load_settings("bh_core.sublime-settings").clear_on_change('key_reload')
+    clear_key_cores()
     bh_regions.clear_all_regions()
+    bh_buffer.clear_snapshots()
+    bh_tokens.clear_token_indexes()
+    bh_pairs.clear_pair_trees()
@@ -5,6 +5,7 @@ Copyright (c) 2013 - 2016 Isaac Muse <isaacmuse@gmail.com>
 License: MIT
 """
 import re
+from BracketHighlighter import bh_plugin
 
 RE_DEF = re.compile(r"\s*(?:(?:private|public|protected)\s+)?(def).*?")
 RE_DEF_ENDLESS = re.compile(
@@ -26,10 +27,9 @@ def validate(view, name, bracket, bracket_side, bfr):
             return False
         view.score_selector
         left = max(0, bracket.begin - 1)
-        previous = bfr[left:bracket.end]
-        m = RE_PREVIOUS.match(previous)
+        m = bh_plugin.BufferView(bfr, left, bracket.end).match(RE_PREVIOUS)
         if m:
-            s = left + m.start(1)
+            s = m.start(1)
             selector = 'meta.function.ruby entity.name.function.ruby, meta.function.parameters.ruby'
             if not view.match_selector(s, selector):
                 return False
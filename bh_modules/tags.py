@@ -5,14 +5,35 @@ Copyright (c) 2013 - 2016 Isaac Muse <isaacmuse@gmail.com>
 License: MIT
 """
 from backrefs import bre
-from collections import namedtuple
+from bisect import bisect_left, bisect_right
+from collections import namedtuple, OrderedDict
+from copy import copy
 import sublime
+import threading
 from os.path import basename, splitext
+from BracketHighlighter import bh_buffer
+from BracketHighlighter import bh_plugin
+from BracketHighlighter import bh_tokens
 
 TAG_OPEN = 0
 TAG_CLOSE = 1
+TAG_MODE_CACHE_SIZE = 64
+TAG_TREE_CACHE_SIZE = 8
+# How far before a change to look for a tag that the change completes
+TAG_TREE_LOOKBEHIND = 4096
+# How much text after a change is sampled at a time to check if the scopes of the tags after it changed
+TAG_TREE_SCOPE_CHUNK = 4096
 
 last_mode = None
+# Tag mode of recent views, per view and syntax
+tag_modes = OrderedDict()
+tag_mode_lock = threading.Lock()
+# Compiled tag patterns and settings, per mode
+tag_mode_settings = {}
+first_line_patterns = {}
+# Tag trees of recent buffers
+tag_trees = OrderedDict()
+tag_tree_lock = threading.Lock()
 
 
 def process_tag_pattern(pattern, variables=None):
@@ -46,28 +67,159 @@ def compare_languge(language, lang_list):
     return found
 
 
-def get_tag_mode(view, tag_mode_config):
-    """Get the tag mode."""
+def get_first_line_pattern(first_line):
+    """Get the compiled `first_line` pattern."""
+
+    pattern = first_line_patterns.get(first_line)
+    if pattern is None:
+        pattern = bre.compile_search(first_line, bre.I)
+        first_line_patterns[first_line] = pattern
+    return pattern
+
+
+def find_tag_mode(view, syntax, tag_mode_config):
+    """Find the tag mode, and whether the first line of the view was needed to find it."""
 
     default_mode = None
-    syntax = view.settings().get('syntax')
+    used_first_line = False
     language = splitext(basename(syntax))[0].lower() if syntax is not None else "plain text"
     if isinstance(tag_mode_config, list):
         for item in tag_mode_config:
             if isinstance(item, dict) and compare_languge(language, item.get('syntax', [])):
                 first_line = item.get('first_line', '')
                 if first_line:
+                    used_first_line = True
                     size = view.size() - 1
                     if size > 256:
                         size = 256
                     if (
                         isinstance(first_line, str) and
-                        bre.compile_search(first_line, bre.I).match(view.substr(sublime.Region(0, size)))
+                        get_first_line_pattern(first_line).match(view.substr(sublime.Region(0, size)))
                     ):
-                        return item.get('mode', default_mode)
+                        return item.get('mode', default_mode), used_first_line
                 else:
-                    return item.get('mode', default_mode)
-    return default_mode
+                    return item.get('mode', default_mode), used_first_line
+    return default_mode, used_first_line
+
+
+def get_tag_mode(view, tag_mode_config):
+    """
+    Get the tag mode.
+
+    The mode is remembered per view and syntax.  If the first line of the view
+    was needed to find it, it is only remembered until the view changes.
+    """
+
+    syntax = view.settings().get('syntax')
+    key = (view.id(), syntax)
+    with tag_mode_lock:
+        entry = tag_modes.get(key)
+        if entry is not None and entry[0] == tag_mode_config and entry[1] in (None, view.change_count()):
+            tag_modes.move_to_end(key)
+            return entry[2]
+
+    mode, used_first_line = find_tag_mode(view, syntax, tag_mode_config)
+    with tag_mode_lock:
+        tag_modes[key] = (tag_mode_config, view.change_count() if used_first_line else None, mode)
+        while len(tag_modes) > TAG_MODE_CACHE_SIZE:
+            tag_modes.popitem(last=False)
+    return mode
+
+
+def get_mode_setting(tag_settings, name, mode, default=None):
+    """Get a tag setting of the mode."""
+
+    try:
+        return tag_settings.get(name)[mode]
+    except Exception:
+        return default
+
+
+def compile_tag_names(pattern):
+    """Compile a pattern of tag names."""
+
+    try:
+        return bre.compile_search(pattern, bre.I)
+    except Exception:
+        return None
+
+
+class TagModeSettings(object):
+    """Compiled tag patterns and settings of a tag mode."""
+
+    def __init__(self, values):
+        """Compile the patterns of the mode."""
+
+        start_tag, attributes, tag_name, end_tag, optional, void, self_closing, scope_exclude, tag_tree = values
+        self.values = values
+        self.tag_open = process_tag_pattern(start_tag, {"attributes": attributes, "tag_name": tag_name})
+        self.tag_close = process_tag_pattern(end_tag)
+        self.optional_tags = compile_tag_names(optional)
+        self.void_tags = compile_tag_names(void)
+        self.self_closing_tags = compile_tag_names(self_closing)
+        self.scope_exclude = scope_exclude
+        self.tag_tree = bool(tag_tree)
+
+    def get_open_tag(self, m):
+        """Get the opening tag of a match."""
+
+        name = m.group(1).lower()
+        self_closing_slash = bool(m.group(2) != "")
+        optional = (
+            self.optional_tags is not None and
+            not self_closing_slash and
+            self.optional_tags.match(name) is not None
+        )
+        self_closing = (
+            self.self_closing_tags is not None and
+            self_closing_slash and
+            self.self_closing_tags.match(name) is not None
+        )
+        void = (
+            not optional and
+            not self_closing and
+            self.void_tags is not None and
+            self.void_tags.match(name) is not None
+        )
+        return TagEntry(m.start(0), m.end(0), name, optional, void or self_closing)
+
+    def get_close_tag(self, m):
+        """Get the closing tag of a match, closing tags of void tags are ignored."""
+
+        name = m.group(1).lower()
+        if self.void_tags is not None and self.void_tags.match(name) is not None:
+            return None
+        return TagEntry(m.start(0), m.end(0), name, False, False)
+
+
+def get_tag_mode_settings(mode):
+    """
+    Get the compiled tag patterns and settings of the mode.
+
+    They are compiled again if the mode's settings in `bh_tag.sublime-settings` change.
+    """
+
+    tag_settings = sublime.load_settings('bh_tag.sublime-settings')
+    try:
+        scope_exclude = tag_settings.get("tag_scope_exclude", {}).get(mode, ['string', 'comment'])
+    except Exception:
+        scope_exclude = ['string', 'comment']
+    values = (
+        tag_settings.get("start_tag")[mode],
+        tag_settings.get('attributes', {}).get(mode, ''),
+        tag_settings.get('tag_name', {}).get(mode, ''),
+        tag_settings.get("end_tag")[mode],
+        get_mode_setting(tag_settings, 'optional_tag_patterns', mode),
+        get_mode_setting(tag_settings, 'void_tag_patterns', mode),
+        get_mode_setting(tag_settings, 'self_closing_tag_patterns', mode),
+        scope_exclude,
+        get_mode_setting(tag_settings, 'tag_tree', mode, False)
+    )
+    entry = tag_mode_settings.get(mode)
+    if entry is None or entry.values != values:
+        entry = TagModeSettings(values)
+        tag_mode_settings[mode] = entry
+    return entry
 
 
 def highlighting(view, name, style, left, right):
@@ -138,11 +290,7 @@ class TagSearch(object):
         self.return_prev = False
         self.done = False
         self.view = view
-        settings = sublime.load_settings("bh_tag.sublime-settings")
-        try:
-            self.scope_exclude = settings.get("tag_scope_exclude", {}).get(mode, ['string', 'comment'])
-        except Exception:
-            self.scope_exclude = ['string', 'comment']
+        self.scope_exclude = get_tag_mode_settings(mode).scope_exclude
 
     def scope_check(self, pt):
         """Check if scope is good."""
@@ -213,36 +361,17 @@ class TagMatch(object):
     def __init__(self, view, bfr, threshold, first, second, center, outside_adj, mode):
         """Prepare tag match object."""
 
-        tag_settings = sublime.load_settings('bh_tag.sublime-settings')
+        mode_settings = get_tag_mode_settings(mode)
         self.view = view
         self.bfr = bfr
+        self.bfr_view = bh_plugin.BufferView(bfr)
         self.mode = mode
-        self.tag_open = process_tag_pattern(
-            tag_settings.get("start_tag")[mode],
-            {
-                "attributes": tag_settings.get('attributes', {}).get(mode, ''),
-                "tag_name": tag_settings.get('tag_name', {}).get(mode, '')
-            }
-        )
-
-        self.tag_close = process_tag_pattern(
-            tag_settings.get("end_tag")[mode]
-        )
-
-        try:
-            self.optional_tags = bre.compile_search(tag_settings.get('optional_tag_patterns')[self.mode], bre.I)
-        except Exception:
-            self.optional_tags = None
-
-        try:
-            self.void_tags = bre.compile_search(tag_settings.get('void_tag_patterns')[self.mode], bre.I)
-        except Exception:
-            self.void_tags = None
-
-        try:
-            self.self_closing_tags = bre.compile_search(tag_settings.get('self_closing_tag_patterns')[self.mode], bre.I)
-        except Exception:
-            self.self_closing_tags = None
+        self.mode_settings = mode_settings
+        self.tag_open = mode_settings.tag_open
+        self.tag_close = mode_settings.tag_close
+        self.optional_tags = mode_settings.optional_tags
+        self.void_tags = mode_settings.void_tags
+        self.self_closing_tags = mode_settings.self_closing_tags
 
         tag, tag_type, tag_end = self.get_first_tag(first[0])
         self.left, self.right = None, None
@@ -280,7 +409,7 @@ class TagMatch(object):
         tag_type = None
         optional = False
         void = False
-        m = self.tag_open.match(self.bfr[offset:])
+        m = self.bfr_view.match(self.tag_open, offset)
         end = None
         if m:
             name = m.group(1).lower()
@@ -301,13 +430,13 @@ class TagMatch(object):
                 self.void_tags is not None and
                 self.void_tags.match(name) is not None
             )
-            start = m.start(0) + offset
-            end = m.end(0) + offset
+            start = m.start(0)
+            end = m.end(0)
             tag = TagEntry(start, end, name, optional, void or self_closing)
             tag_type = "open"
             self.center = end
         else:
-            m = self.tag_close.match(self.bfr[offset:])
+            m = self.bfr_view.match(self.tag_close, offset)
             if m:
                 name = m.group(1).lower()
                 void = (
@@ -315,8 +444,8 @@ class TagMatch(object):
                     self.void_tags.match(name) is not None
                 )
                 if not void:
-                    start = m.start(0) + offset
-                    end = m.end(0) + offset
+                    start = m.start(0)
+                    end = m.end(0)
                     tag = TagEntry(start, end, name, optional, void)
                     tag_type = "close"
                     self.center = offset
@@ -348,6 +477,31 @@ class TagMatch(object):
                     b = None
         return found_tag
 
+    def match_tree(self):
+        """
+        Find the corresponding open or close with the buffer's tag tree.
+
+        Tags outside the search window are not used.  `None` is returned if the tag is not in the tree.
+        """
+
+        tree = get_tag_tree(self.view, self.bfr, self.mode_settings)
+        if self.left is not None:
+            index = tree.get_element(self.left.begin)
+            if index is None or tree.lefts[index] != self.left:
+                return None
+            right = tree.rights[index]
+            if right is not None and right is not tree.lefts[index] and right.end > self.window[1]:
+                right = None
+            return self.left, right
+
+        index = tree.get_closed(self.right.begin)
+        if index is None or (index != -1 and tree.rights[index] != self.right):
+            return None
+        left = tree.lefts[index] if index != -1 else None
+        if left is not None and left.begin < self.window[0]:
+            left = None
+        return left, self.right
+
     def match(self):
         """
         Find the corresponding open or close.
@@ -361,6 +515,11 @@ class TagMatch(object):
         if self.no_tag or (self.left and self.right):
             return self.left, self.right
 
+        if self.mode_settings.tag_tree:
+            found = self.match_tree()
+            if found is not None:
+                return found
+
         # Initialize tag matching objects
         osearch = TagSearch(
             self.view, self.bfr, self.window,
@@ -384,10 +543,12 @@ class TagMatch(object):
 
         # Match the tags
         for c in csearch.get_tags():
+            bh_plugin.check_deadline()
             if len(stack) and osearch.done:
                 if self.resolve_optional(stack, c):
                     continue
             for o in osearch.get_tags():
+                bh_plugin.check_deadline()
                 if o.end <= c.begin:
                     if not o.single:
                         stack.append(o)
@@ -422,3 +583,574 @@ class TagMatch(object):
             self.right = self.left
 
         return self.left, self.right
+
+
+def common_prefix(a, b):
+    """Get the length of the text the start of two strings have in common."""
+
+    lo = 0
+    hi = min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def common_suffix(a, b, limit):
+    """Get the length of the text the end of two strings have in common, up to the limit."""
+
+    lo = 0
+    hi = limit
+    size_a = len(a)
+    size_b = len(b)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[size_a - mid:size_a - lo] == b[size_b - mid:size_b - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def shift_tags(tags, delta):
+    """Move tags by the given amount."""
+
+    # Tags are made directly from tuples, as there can be a lot of them
+    new = tuple.__new__
+    return [new(TagEntry, (t[0] + delta, t[1] + delta, t[2], t[3], t[4])) for t in tags]
+
+
+def count_opened(lefts, starts, key):
+    """Count the elements that were opened before the pairing event `key`."""
+
+    count = bisect_right(starts, key[0])
+    while count and (lefts[count - 1].end, TAG_OPEN) >= key:
+        count -= 1
+    return count
+
+
+def get_open_elements(parents, pops, count, key):
+    """Get the elements that were still open at the pairing event `key`, outermost first."""
+
+    index = count - 1
+    while index != -1 and pops[index] is not None and pops[index] < key:
+        index = parents[index]
+    stack = []
+    while index != -1:
+        stack.append(index)
+        index = parents[index]
+    stack.reverse()
+    return stack
+
+
+class TagTree(object):
+    """
+    All tags of a buffer, paired up into elements.
+
+    Tags are found with one pass over the buffer.  When the buffer changes, only
+    the tags around the change are found again, and only their scopes are sampled.
+    Pairing picks up from where it was just before the change, and once it is back
+    in step with the previous pairing, the rest of the elements are shifted.
+    Optional tags are resolved once when the tags are paired, and elements are
+    stored in buffer order with the index of their parent, so the element that
+    encloses a point can be found with a bisect and a short walk up the parents.
+    """
+
+    def __init__(self, buffer_id, mode_settings):
+        """Setup the tree."""
+
+        self.buffer_id = buffer_id
+        self.mode_settings = mode_settings
+        self.change_count = None
+        self.scope_key = None
+        self.bfr = None
+        # Opening and closing tags of the buffer, where they start, and the scope they start in
+        self.tags = ([], [])
+        self.begins = ([], [])
+        self.scopes = ([], [])
+        # Whether tags in a scope are excluded
+        self.excluded = {}
+        # Elements: their opening tag, closing tag (if any), parent's index, and the pairing event that closed them.
+        # Tags that close themselves, and optional tags that were closed by another tag, are their own closing tag.
+        self.lefts = []
+        self.starts = []
+        self.rights = []
+        self.parents = []
+        self.pops = []
+        # Element closed by each closing tag, -1 if it doesn't close one, `None` if the tag is excluded.
+        self.closed = []
+
+    def get_pattern(self, kind):
+        """Get the pattern of a kind of tag."""
+
+        return self.mode_settings.tag_open if kind == TAG_OPEN else self.mode_settings.tag_close
+
+    def find_tags(self, kind, bfr, begin, tail, sync):
+        """
+        Find the tags of a kind from a point of the buffer.
+
+        Once a tag at or after `sync` lines up with a tag in `tail`, the rest
+        of the tags are known.  The tags found are returned with the index of
+        the tag in `tail` they lined up with.
+        """
+
+        get_tag = self.mode_settings.get_open_tag if kind == TAG_OPEN else self.mode_settings.get_close_tag
+        tail_begins = [t.begin for t in tail]
+        found = []
+        for m in self.get_pattern(kind).finditer(bfr, begin):
+            start = m.start(0)
+            if sync is not None and start >= sync:
+                index = bisect_left(tail_begins, start)
+                if index < len(tail) and tail_begins[index] == start and tail[index].end == m.end(0):
+                    return found, index
+            tag = get_tag(m)
+            if tag is not None:
+                found.append(tag)
+        return found, len(tail)
+
+    def find_reach(self, kind, bfr, pt):
+        """
+        Find where the first tag of a kind that now reaches past a point starts.
+
+        An edit can complete a tag that starts before it, such as an opening tag whose attribute
+        holds other tags, so tags that start a short way before the point are checked.
+        """
+
+        pattern = self.get_pattern(kind)
+        pos = max(0, pt - TAG_TREE_LOOKBEHIND)
+        while True:
+            m = pattern.search(bfr, pos)
+            if m is None or m.start(0) >= pt:
+                return pt
+            if m.end(0) > pt:
+                return m.start(0)
+            pos = m.start(0) + 1
+
+    def is_excluded(self, scope):
+        """Check if tags in a scope are excluded."""
+
+        found = self.excluded.get(scope)
+        if found is None:
+            found = any(sublime.score_selector(scope, exclude) for exclude in self.mode_settings.scope_exclude)
+            self.excluded[scope] = found
+        return found
+
+    def check_scopes(self, tags, scopes, index, scope_map, size):
+        """
+        Check the scopes of the tags after a change, as the change can alter the scopes after it.
+
+        The text after the change is sampled a chunk at a time until a chunk whose tags kept their scopes.
+        The index of the first tag after the last one whose scope changed is returned.
+        """
+
+        stable = index
+        count = len(tags)
+        while index < count:
+            chunk_end = min(size, tags[index].begin + TAG_TREE_SCOPE_CHUNK)
+            scope_map.sample(tags[index].begin, chunk_end)
+            changed = False
+            while index < count and tags[index].begin < chunk_end:
+                scope = scope_map.scope_name(tags[index].begin)
+                if scope != scopes[index]:
+                    scopes[index] = scope
+                    changed = True
+                    stable = index + 1
+                index += 1
+            if not changed:
+                break
+        return stable
+
+    def get_change(self, bfr, change_count):
+        """Get the span of the buffer that changed since the last update as `(begin, old end, new end)`."""
+
+        old = self.bfr
+        span = bh_tokens.get_change_span(self.buffer_id, self.change_count, change_count)
+        if span is not None and span[1] <= len(old) and span[2] - span[1] == len(bfr) - len(old):
+            return span
+
+        # The changes are not known, so find what changed
+        prefix = common_prefix(old, bfr)
+        suffix = common_suffix(old, bfr, min(len(old), len(bfr)) - prefix)
+        return prefix, len(old) - suffix, len(bfr) - suffix
+
+    def is_current(self, view, change_count):
+        """Check if the tree is up to date with the buffer and its scopes."""
+
+        return (
+            self.bfr is not None and self.change_count == change_count and
+            self.scope_key == bh_buffer.get_scope_key(view)
+        )
+
+    def update(self, view, bfr, change_count):
+        """Bring the tree up to date with the buffer."""
+
+        if self.is_current(view, change_count):
+            return
+
+        scope_key = bh_buffer.get_scope_key(view)
+
+        scope_map = self.get_scope_map(view)
+        if self.bfr is None or self.change_count == change_count or self.scope_key[0] != scope_key[0]:
+            # New tree, or the scopes may have been parsed again, so find and sample everything.
+            self.build(bfr, scope_map)
+        else:
+            self.apply_change(bfr, scope_map, self.get_change(bfr, change_count))
+        self.bfr = bfr
+        self.change_count = change_count
+        self.scope_key = scope_key
+
+    def build(self, bfr, scope_map):
+        """Find all the tags of the buffer and pair them up."""
+
+        size = len(bfr)
+        scope_map.sample(0, size)
+        tags = ([], [])
+        scopes = ([], [])
+        for kind in (TAG_OPEN, TAG_CLOSE):
+            tags[kind].extend(self.find_tags(kind, bfr, 0, [], None)[0])
+            scopes[kind].extend(scope_map.scope_name(t.begin) for t in tags[kind])
+        self.pair(tags, scopes, 0)
+
+    def apply_change(self, bfr, scope_map, span):
+        """Find the tags around a change to the buffer again, shift the tags after it, and pair them up."""
+
+        prefix, old_end, new_end = span
+        delta = new_end - old_end
+        size = len(bfr)
+        tags = ([], [])
+        scopes = ([], [])
+        stable = [0, 0]
+        cut = size
+        for kind in (TAG_OPEN, TAG_CLOSE):
+            old_tags = self.tags[kind]
+            begins = self.begins[kind]
+
+            # Keep the tags that end before the change, or before a tag that now reaches into it,
+            # and scan again from the last of them.
+            reach = self.find_reach(kind, bfr, prefix)
+            first = bisect_left(begins, reach)
+            while first and old_tags[first - 1].end > reach:
+                first -= 1
+            begin = old_tags[first - 1].end if first else 0
+            cut = min(cut, begin)
+
+            # Tags after the change are shifted and used to tell when scanning is back in sync.
+            last = bisect_left(begins, old_end)
+            tail = shift_tags(old_tags[last:], delta)
+            found, index = self.find_tags(kind, bfr, begin, tail, new_end)
+            if found:
+                scope_map.sample(begin, found[-1].end)
+            tags[kind].extend(old_tags[:first])
+            tags[kind].extend(found)
+            tags[kind].extend(tail[index:])
+            scopes[kind].extend(self.scopes[kind][:first])
+            scopes[kind].extend(scope_map.scope_name(t.begin) for t in found)
+            scopes[kind].extend(self.scopes[kind][last + index:])
+            stable[kind] = self.check_scopes(tags[kind], scopes[kind], first + len(found), scope_map, size)
+
+        self.pair(tags, scopes, cut, stable, (prefix, old_end, delta))
+
+    @staticmethod
+    def get_scope_map(view):
+        """Get the scopes of the buffer, they are shared with the bracket search of the same snapshot."""
+
+        scope_map = getattr(view, 'scope_map', None)
+        if scope_map is None:
+            scope_map = bh_buffer.get_snapshot(view).get_scope_map(view)
+        return scope_map
+
+    def pair(self, tags, scopes, cut, stable=None, change=None):
+        """
+        Pair up the tags from a point of the buffer.
+
+        Tags are paired in the same order a tag search would see them: an opening tag
+        comes before a closing tag if it ends before the closing tag starts.
+
+        Pairing picks up from the state the previous pairing was in at `cut`.  Once only tags that were
+        shifted over from before are left, from the `stable` index of each kind on, pairing stops as
+        soon as it is back in step with the previous pairing, and the rest of that is shifted over.
+        """
+
+        opens, closes = tags
+        open_scopes, close_scopes = scopes
+        open_begins = [t.begin for t in opens]
+        close_begins = [t.begin for t in closes]
+
+        # Start with the elements opened before the cut, and the ones of them that were still open
+        key = (cut, TAG_CLOSE)
+        count = count_opened(self.lefts, self.starts, key)
+        stack = get_open_elements(self.parents, self.pops, count, key)
+        lefts = self.lefts[:count]
+        rights = self.rights[:count]
+        parents = self.parents[:count]
+        pops = self.pops[:count]
+        for index in stack:
+            rights[index] = None
+            pops[index] = None
+        o = bisect_right(open_begins, cut)
+        if o and opens[o - 1].end > cut:
+            o -= 1
+        c = bisect_left(close_begins, cut)
+        closed = self.closed[:c]
+        elements = (lefts, rights, parents, pops, closed)
+
+        open_count = len(opens)
+        close_count = len(closes)
+        synced = False
+        while True:
+            while o < open_count and self.is_excluded(open_scopes[o]):
+                o += 1
+            while c < close_count and self.is_excluded(close_scopes[c]):
+                closed.append(None)
+                c += 1
+            if o == open_count and c == close_count:
+                break
+
+            if o < open_count and (c == close_count or opens[o].end <= closes[c].begin):
+                key = (opens[o].end, TAG_OPEN)
+            else:
+                key = (closes[c].begin, TAG_CLOSE)
+
+            if stable is not None and o >= stable[TAG_OPEN] and c >= stable[TAG_CLOSE]:
+                synced = self.resync(tags, scopes, (o, c), key, elements + (stack,), change)
+                if synced:
+                    break
+
+            if key[1] == TAG_OPEN:
+                tag = opens[o]
+                o += 1
+                index = len(lefts)
+                lefts.append(tag)
+                rights.append(tag if tag.single else None)
+                parents.append(stack[-1] if stack else -1)
+                pops.append(key if tag.single else None)
+                if not tag.single:
+                    stack.append(index)
+                continue
+
+            tag = closes[c]
+            c += 1
+            closed.append(-1)
+            while stack:
+                index = stack[-1]
+                if lefts[index].name == tag.name:
+                    stack.pop()
+                    rights[index] = tag
+                    pops[index] = key
+                    closed[-1] = index
+                    break
+                elif lefts[index].optional:
+                    # Optional tags are closed by the closing tag of an outer element
+                    stack.pop()
+                    rights[index] = lefts[index]
+                    pops[index] = key
+                else:
+                    break
+
+        if not synced:
+            for index in stack:
+                if lefts[index].optional:
+                    rights[index] = lefts[index]
+
+        self.tags = tags
+        self.begins = (open_begins, close_begins)
+        self.scopes = scopes
+        self.lefts = lefts
+        self.starts = [t.begin for t in lefts]
+        self.rights = rights
+        self.parents = parents
+        self.pops = pops
+        self.closed = closed
+
+    def resync(self, tags, scopes, positions, key, state, change):
+        """
+        Shift the rest of the previous pairing over if pairing is back in step with it at the event `key`.
+
+        Pairing is back in step if the same elements are open as were open at the same event before.
+        The rest of the elements are then opened by the opening tags from the current position on, and
+        are closed by the closing tags from the current position on that closed them before.
+        """
+
+        lefts, rights, parents, pops, closed, stack = state
+        prefix, old_end, delta = change
+        o, c = positions
+        old_key = (key[0] - delta, key[1])
+        old_count = count_opened(self.lefts, self.starts, old_key)
+        old_stack = get_open_elements(self.parents, self.pops, old_count, old_key)
+        if len(old_stack) != len(stack):
+            return False
+        for index, old_index in zip(reversed(stack), reversed(old_stack)):
+            old_tag = self.lefts[old_index]
+            if old_tag.begin >= old_end:
+                old_tag = old_tag.move(old_tag.begin + delta, old_tag.end + delta)
+            elif old_tag.end > prefix:
+                return False
+            if lefts[index] != old_tag:
+                return False
+
+        # The elements left must be the same as before, as a tag found again can swallow the tags after it.
+        # Tags from here on were shifted over with their scopes, so they line up if the first element does.
+        opens, open_scopes = tags[TAG_OPEN], scopes[TAG_OPEN]
+        while o < len(opens) and self.is_excluded(open_scopes[o]):
+            o += 1
+        if old_count < len(self.lefts):
+            if o == len(opens) or opens[o].begin - delta != self.lefts[old_count].begin:
+                return False
+        elif o != len(opens):
+            return False
+        closes = tags[TAG_CLOSE]
+        old_close = c - len(closes) + len(self.tags[TAG_CLOSE])
+        if old_close < 0 or len(closes) - c != len(self.closed) - old_close:
+            return False
+
+        offset = len(lefts) - old_count
+        moved = dict(zip(old_stack, stack))
+        moved[-1] = -1
+
+        def shift_pop(pop):
+            """Move the event that closed an element."""
+
+            return (pop[0] + delta, pop[1]) if pop is not None else None
+
+        for old_index, index in moved.items():
+            if index != -1:
+                rights[index] = lefts[index] if self.rights[old_index] is self.lefts[old_index] else None
+                pops[index] = shift_pop(self.pops[old_index])
+
+        # The rest of the elements are opened by the opening tags from here on...
+        first = len(lefts)
+        lefts.extend(t for t, scope in zip(opens[o:], open_scopes[o:]) if not self.is_excluded(scope))
+        rights.extend(
+            left if right is old_left else None
+            for left, old_left, right in zip(lefts[first:], self.lefts[old_count:], self.rights[old_count:])
+        )
+        parents.extend(p + offset if p >= old_count else moved[p] for p in self.parents[old_count:])
+        pops.extend(shift_pop(p) for p in self.pops[old_count:])
+
+        # ...and are closed by the same closing tags as before.
+        for tag, old_index in zip(closes[c:], self.closed[old_close:]):
+            if old_index is None:
+                closed.append(None)
+                continue
+            index = old_index + offset if old_index >= old_count else moved[old_index]
+            closed.append(index)
+            if index != -1:
+                rights[index] = tag
+        return True
+
+    def get_element(self, begin):
+        """Get the element whose opening tag starts at the given point."""
+
+        index = bisect_left(self.starts, begin)
+        if index < len(self.starts) and self.starts[index] == begin:
+            return index
+        return None
+
+    def get_closed(self, begin):
+        """
+        Get the element closed by the closing tag that starts at the given point.
+
+        `-1` is returned if the tag doesn't close an element, and `None` if it isn't in the tree.
+        """
+
+        begins = self.begins[TAG_CLOSE]
+        index = bisect_left(begins, begin)
+        if index < len(begins) and begins[index] == begin:
+            return self.closed[index]
+        return None
+
+    def find(self, pt):
+        """Get the innermost element that encloses the point."""
+
+        index = bisect_right(self.starts, pt) - 1
+        while index != -1:
+            right = self.rights[index]
+            if right is not None and right.end > pt:
+                return index
+            index = self.parents[index]
+        return None
+
+    def get_tags(self, index):
+        """Get the opening and closing tag of an element."""
+
+        return self.lefts[index], self.rights[index]
+
+    def get_parent(self, index):
+        """Get the parent of an element."""
+
+        parent = self.parents[index]
+        return parent if parent != -1 else None
+
+    def get_children(self, index):
+        """Get the children of an element, they come right after it and before the next element that isn't inside it."""
+
+        children = []
+        parents = self.parents
+        for child in range(index + 1, len(parents)):
+            parent = parents[child]
+            if parent < index:
+                break
+            if parent == index:
+                children.append(child)
+        return children
+
+    def get_siblings(self, index):
+        """Get the other children of the element's parent."""
+
+        return [i for i in self.get_children(self.parents[index]) if i != index]
+
+
+def get_tag_tree(view, bfr, mode_settings):
+    """
+    Get the tag tree of the view's buffer, updated to the buffer's current state.
+
+    Trees are never changed once they are shared, as matches off the main thread use them too.
+    A copy of the tree is updated outside the lock, so no thread waits on another's update,
+    and it replaces the shared tree unless a newer one was stored in the meantime.
+    """
+
+    buffer_id = view.buffer_id()
+    change_count = view.change_count()
+    with tag_tree_lock:
+        tree = tag_trees.get(buffer_id)
+    if tree is not None and tree.mode_settings is mode_settings and tree.is_current(view, change_count):
+        return tree
+
+    tree = copy(tree) if tree is not None and tree.mode_settings is mode_settings else TagTree(buffer_id, mode_settings)
+    tree.update(view, bfr, change_count)
+
+    with tag_tree_lock:
+        current = tag_trees.get(buffer_id)
+        if (
+            current is None or current.mode_settings is not mode_settings or
+            current.change_count <= tree.change_count
+        ):
+            tag_trees[buffer_id] = tree
+            while len(tag_trees) > TAG_TREE_CACHE_SIZE:
+                tag_trees.popitem(last=False)
+        if buffer_id in tag_trees:
+            tag_trees.move_to_end(buffer_id)
+    return tree
+
+
+def discard_tag_tree(buffer_id):
+    """Discard the tag tree of a buffer."""
+
+    with tag_tree_lock:
+        tag_trees.pop(buffer_id, None)
+
+
+bh_buffer.add_buffer_discard('tags', discard_tag_tree)
+
+
+def get_view_tag_tree(view):
+    """Get the tag tree of a view for plugins, or `None` if there is no tag mode for the view."""
+
+    tag_settings = sublime.load_settings("bh_tag.sublime-settings")
+    mode = get_tag_mode(view, tag_settings.get("tag_mode", []))
+    if mode is None:
+        return None
+    return get_tag_tree(view, bh_buffer.get_snapshot(view).text, get_tag_mode_settings(mode))
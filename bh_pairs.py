@@ -0,0 +1,235 @@
+"""
+BracketHighlighter.
+
+Copyright (c) 2013 - 2017 Isaac Muse <isaacmuse@gmail.com>
+License: MIT
+
+Bracket pair tree.
+"""
+import threading
+from bisect import bisect_left
+from . import bh_plugin
+
+pair_trees = {}
+pair_tree_lock = threading.Lock()
+# Sizes at which buffers' trees could not be built in time
+oversized = {}
+
+
+def get_rules_key(rules):
+    """
+    Get what the pairs of a buffer depend on in the rules: the revision they were loaded at, and their pattern.
+
+    Matchers with other adjacency modes, like the key commands, load the same brackets, so they can share a tree.
+    """
+
+    return rules.revision, rules.pattern.pattern if rules.pattern is not None else None
+
+
+class PairTree(object):
+    """
+    All bracket pairs of a buffer.
+
+    Pairs are found with a single pass over the buffer's brackets.
+    Opening brackets are stored in buffer order along with their closing
+    bracket and the index of their parent, so the pair that encloses
+    a point can be found with a bisect and a short walk up the parents.
+    """
+
+    def __init__(self, buffer_id, change_count, rules):
+        """Setup the tree."""
+
+        self.buffer_id = buffer_id
+        self.change_count = change_count
+        self.key = get_rules_key(rules)
+        # Opening brackets, their closing bracket (if any), whether the two match, and their parent's index.
+        self.opens = []
+        self.starts = []
+        self.closes = []
+        self.matches = []
+        self.parents = []
+        # Where an opening bracket's content ends: the end of its closing bracket, `None` if it has none.
+        self.limits = []
+        # Where the first child of an opening bracket that has a pair that doesn't match ends,
+        # and where the last such child starts.
+        self.first_bad = []
+        self.last_bad = []
+        # The end of every bracket, used to check if a bracket touches a point.
+        self.ends = []
+        # Closing brackets that are not inside any opening bracket,
+        # and where the pairs that are not inside any opening bracket, and have a pair that doesn't match, start.
+        self.orphans = []
+        self.orphan_ends = []
+        self.bad_starts = []
+
+    def is_current(self, change_count, rules):
+        """Check if the tree reflects the current buffer and rules."""
+
+        return self.change_count == change_count and self.key == get_rules_key(rules)
+
+    def build(self, brackets, validate, compare):
+        """
+        Pair up the brackets.
+
+        `brackets` yields `(bracket, match_type)` in buffer order.
+        Brackets are paired the same way a search outward from a cursor pairs them:
+        a closing bracket is paired with the innermost opening bracket whether they match or not.
+        A search that passes over a pair that doesn't match stops there, so where such
+        pairs are is remembered for the parent of the pair they are in.
+
+        Raises `MatchTimeout` if the thread's deadline passes before every bracket is paired.
+        """
+
+        stack = []
+        # Whether each pair has a pair that doesn't match in it
+        bad = []
+        for b, match_type in brackets:
+            bh_plugin.check_deadline()
+            self.ends.append(b.end)
+            if not validate(b, match_type):
+                continue
+            if match_type == 0:
+                stack.append(len(self.opens))
+                self.opens.append(b)
+                self.starts.append(b.begin)
+                self.closes.append(None)
+                self.matches.append(False)
+                self.limits.append(None)
+                self.parents.append(stack[-2] if len(stack) > 1 else -1)
+                self.first_bad.append(None)
+                self.last_bad.append(None)
+                bad.append(False)
+                continue
+
+            if not stack:
+                self.orphans.append(b)
+                self.orphan_ends.append(b.end)
+                continue
+
+            index = stack.pop()
+            self.closes[index] = b
+            self.limits[index] = b.end
+            self.matches[index] = compare(self.opens[index], b)
+            if bad[index] or not self.matches[index]:
+                parent = self.parents[index]
+                if parent == -1:
+                    self.bad_starts.append(self.opens[index].begin)
+                    continue
+                bad[parent] = True
+                if self.first_bad[parent] is None:
+                    self.first_bad[parent] = b.end
+                self.last_bad[parent] = self.opens[index].begin
+
+    def touches(self, pt):
+        """Check if a bracket ends at the given point."""
+
+        index = bisect_left(self.ends, pt)
+        return index < len(self.ends) and self.ends[index] == pt
+
+    def find(self, center, window, outside_adj=False, block_cursor=False):
+        """
+        Find the brackets that enclose the given point within the search window.
+
+        Brackets are sorted to the left or right of the point with the same
+        rules as `BracketSearch` so that adjacent brackets are treated the same.
+        Like a search outward from the point, a side is not found if a pair that
+        doesn't match is passed over, and the closing bracket is not kept if it
+        doesn't match the opening bracket.
+        """
+
+        touch_right = outside_adj and self.touches(center)
+
+        index = bisect_left(self.starts, center)
+        if (
+            index < len(self.starts) and self.starts[index] == center and
+            (block_cursor or (outside_adj and not touch_right))
+        ):
+            # Opening bracket adjacent on the right is treated as if it were on the left
+            index += 1
+        index -= 1
+
+        while index != -1:
+            limit = self.limits[index]
+            if limit is None or limit > center or (outside_adj and limit == center):
+                break
+            index = self.parents[index]
+
+        if index != -1:
+            left, right = self.opens[index], self.closes[index]
+            if self.first_bad[index] is not None and self.first_bad[index] <= center:
+                left = None
+            if self.last_bad[index] is not None and self.last_bad[index] >= center:
+                right = None
+        else:
+            left = None
+            orphan = bisect_left(self.orphan_ends, center if outside_adj else center + 1)
+            right = self.orphans[orphan] if orphan < len(self.orphans) else None
+            if right is not None:
+                bad = bisect_left(self.bad_starts, center)
+                if bad < len(self.bad_starts) and self.bad_starts[bad] < right.begin:
+                    right = None
+
+        # Respect the search window
+        if left is not None and left.begin < window[0]:
+            left = None
+        if right is not None and right.end > window[1]:
+            right = None
+
+        if left is not None and right is not None and not self.matches[index]:
+            right = None
+        return left, right
+
+
+def get_pair_tree(buffer_id, change_count, rules):
+    """Get the buffer's pair tree if it is still current."""
+
+    with pair_tree_lock:
+        tree = pair_trees.get(buffer_id)
+    if tree is not None and not tree.is_current(change_count, rules):
+        tree = None
+    return tree
+
+
+def set_pair_tree(tree):
+    """
+    Store the buffer's pair tree.
+
+    Trees are built on whichever thread matches, so a tree of an older change count
+    never replaces a newer one built with the same rules.  Trees are not changed once built, so they can be shared.
+    """
+
+    with pair_tree_lock:
+        current = pair_trees.get(tree.buffer_id)
+        if current is None or current.key != tree.key or current.change_count <= tree.change_count:
+            pair_trees[tree.buffer_id] = tree
+
+
+def is_oversized(buffer_id, size):
+    """Check if the buffer is too large for its tree to be built in time."""
+
+    with pair_tree_lock:
+        limit = oversized.get(buffer_id)
+    return limit is not None and size >= limit
+
+
+def set_oversized(buffer_id, size):
+    """Remember that the buffer's tree could not be built in time at the given size."""
+
+    with pair_tree_lock:
+        oversized[buffer_id] = size
+
+
+def discard_pair_tree(buffer_id):
+    """Discard the pair tree of a buffer."""
+
+    with pair_tree_lock:
+        pair_trees.pop(buffer_id, None)
+        oversized.pop(buffer_id, None)
+
+
+def clear_pair_trees():
+    """Discard all pair trees."""
+
+    with pair_tree_lock:
+        pair_trees.clear()
+        oversized.clear()
@@ -9,10 +9,14 @@ import sublime_plugin
 from os.path import normpath, join
 from collections import namedtuple
 import sys
+import threading
 import traceback
 import re
+from time import time
 from .bh_logging import log
 
+match_budget = threading.local()
+
 
 class Payload(object):
     """Plugin payload."""
@@ -49,12 +53,86 @@ class BracketRegion (namedtuple('BracketRegion', ['begin', 'end'])):
         return sublime.Region(self.begin, self.end)
 
 
+class BufferView(object):
+    """
+    Part of a buffer that can be matched against without copying it.
+
+    Patterns are matched with `pos` and `endpos`, so match positions are points in the buffer.
+    Unlike a slice, lookbehinds can see the text before `begin`.
+    """
+
+    def __init__(self, bfr, begin=0, end=None):
+        """Setup the view of the buffer."""
+
+        self.bfr = bfr
+        self.begin = begin
+        self.end = len(bfr) if end is None else end
+
+    def __len__(self):
+        """Get the size of the view."""
+
+        return self.end - self.begin
+
+    def __str__(self):
+        """Copy the text of the view."""
+
+        return self.bfr[self.begin:self.end]
+
+    def match(self, pattern, pt=None):
+        """Match the pattern at the given point, or at the start of the view."""
+
+        return pattern.match(self.bfr, self.begin if pt is None else pt, self.end)
+
+    def search(self, pattern, pt=None):
+        """Search for the pattern from the given point, or from the start of the view."""
+
+        return pattern.search(self.bfr, self.begin if pt is None else pt, self.end)
+
+    def finditer(self, pattern, pt=None):
+        """Find all matches of the pattern from the given point, or from the start of the view."""
+
+        return pattern.finditer(self.bfr, self.begin if pt is None else pt, self.end)
+
+    def substr(self, begin, end):
+        """Get the text between two points of the buffer, clipped to the view."""
+
+        return self.bfr[max(begin, self.begin):min(end, self.end)]
+
+
 def is_bracket_region(obj):
     """Check if object is a `BracketRegion`."""
 
     return isinstance(obj, BracketRegion)
 
 
+class MatchTimeout(BaseException):
+    """
+    Raised when a match runs out of time.
+
+    It doesn't derive from `Exception`, so plugin hooks that catch broad exceptions don't stop it.
+    """
+
+
+def set_deadline(deadline):
+    """Set the time the current thread's match must finish by, `None` removes the limit."""
+
+    match_budget.deadline = deadline
+
+
+def get_deadline():
+    """Get the time the current thread's match must finish by, if any."""
+
+    return getattr(match_budget, 'deadline', None)
+
+
+def check_deadline():
+    """Raise `MatchTimeout` if the current thread's match has run out of time."""
+
+    deadline = getattr(match_budget, 'deadline', None)
+    if deadline is not None and time() > deadline:
+        raise MatchTimeout()
+
+
 def sublime_format_path(pth):
     """Format path for Sublime internally."""
     m = re.match(r"^([A-Za-z]{1}):(?:/|\\)(.*)", pth)
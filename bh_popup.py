@@ -29,6 +29,7 @@ MATCH_ERR = '''
     - There *might* be no match.
     - Brackets *might* be nested poorly --> `([)(])`
     - Matching bracket *might* be beyond the search threshold.
+    - Matching *might* have run out of time.
     A match done without the threshold *might* find it.
 
 [(Match brackets without threshold)](%(pt)s)
@@ -38,6 +39,7 @@ MATCH_ERR = '''
 - There *might* be no match.
 - Brackets *might* be nested poorly --> `([)(])`
 - Matching bracket *might* be beyond the search threshold.
+- Matching *might* have run out of time.
 A match done without the threshold *might* find it.
 [(Match brackets without threshold)](%(pt)s)
 \x02{%%- endif %%}\x03
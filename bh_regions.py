@@ -5,6 +5,10 @@ Copyright (c) 2013 - 2016 Isaac Muse <isaacmuse@gmail.com>
 License: MIT
 """
 import sublime
+from bisect import bisect_left
+from collections import namedtuple
+from . import bh_buffer
+from . import bh_state
 
 
 DEFAULT_STYLES = {
@@ -17,35 +21,325 @@ DEFAULT_STYLES = {
         "icon": "question",
         "color": "brackethighlighter.unmatched",
         "style": "outline"
+    },
+    "unresolved": {
+        "icon": "question",
+        "color": "brackethighlighter.unresolved",
+        "style": "outline"
     }
 }
 HV_RSVD_VALUES = ["__default__", "__bracket__"]
+# Characters to draw clipped regions in beyond the visible region, if the visible region is smaller
+BH_CLIP_MARGIN = 2048
+# Milliseconds between checks of the viewport of a view with clipped regions
+BH_CLIP_POLL = 100
+# Checks in a row the viewport must stay put for before it is no longer watched
+BH_CLIP_IDLE_POLLS = 10
+
+
+class UnderlineSpan(namedtuple('UnderlineSpan', ['begin', 'end'])):
+    """A span of text to underline one character at a time."""
+
+
+class ClippedSpan(namedtuple('ClippedSpan', ['begin', 'end'])):
+    """A span of text that is only drawn where it is near the visible region."""
 
 
 def underline(regions):
-    """Convert sublime regions into underline regions."""
+    """Convert sublime regions into underline spans."""
+
+    return [UnderlineSpan(region.begin(), region.end()) for region in regions if not region.empty()]
+
+
+def expand_regions(regions, begin, end):
+    """
+    Convert spans and content bars into regions.
+
+    Underline spans are drawn as one empty region per character.  Only the regions
+    within the given window are converted.  Whether anything was clipped by the
+    window is returned along with the regions.
+    """
 
     r = []
+    clipped = False
     for region in regions:
-        start = region.begin()
-        end = region.end()
-        while start < end:
-            r.append(sublime.Region(start))
-            start += 1
-    return r
+        if isinstance(region, UnderlineSpan):
+            start = max(region.begin, begin)
+            stop = min(region.end, end)
+            if start != region.begin or stop != region.end:
+                clipped = True
+            while start < stop:
+                r.append(sublime.Region(start))
+                start += 1
+        elif isinstance(region, ClippedSpan):
+            start = max(region.begin, begin)
+            stop = min(region.end, end)
+            if start != region.begin or stop != region.end:
+                clipped = True
+            if start < stop:
+                r.append(sublime.Region(start, stop))
+        elif isinstance(region, ContentBar):
+            bars, bars_clipped = region.get_regions(begin, end)
+            r.extend(bars)
+            clipped = clipped or bars_clipped
+        else:
+            r.append(region)
+    return r, clipped
+
+
+def get_draw_window(view, clip_to_viewport=True):
+    """Get the part of the view that clipped regions are drawn in."""
+
+    if not clip_to_viewport:
+        return 0, view.size()
+    visible = view.visible_region()
+    margin = max(visible.size(), BH_CLIP_MARGIN)
+    return max(0, visible.begin() - margin), visible.end() + margin
+
+
+def is_shown(view):
+    """Check if the view is the one shown in its group."""
+
+    window = view.window()
+    if window is None:
+        return False
+    group = window.get_view_index(view)[0]
+    return window.active_view_in_group(group) == view
+
+
+def refresh_clipped_regions(view):
+    """
+    Redraw the last update of a view if it has clipped regions that have scrolled into view.
+
+    Regions matched before the buffer last changed are left for the next match to draw.
+    Returns whether the view still needs to be watched.
+    """
+
+    state = bh_state.view_states.get(view.id())
+    if state is None or state.clip is None or state.update is None:
+        return False
+    if view.change_count() != state.update.change_count:
+        return False
+    visible = view.visible_region()
+    if visible.begin() < state.clip[0] or visible.end() > state.clip[1]:
+        state.update.draw(view)
+    return state.clip is not None
+
+
+def watch_clipped_regions(view):
+    """
+    Poll the view's viewport while it has clipped regions and is being scrolled.
+
+    Polling stops once the viewport has stayed put for a while, nothing is clipped any more,
+    or the view is hidden or closed.  It starts again when the view is next drawn or used.
+    """
+
+    state = bh_state.get_view_state(view.id())
+    state.idle = 0
+    if state.watching:
+        return
+    state.watching = True
+    visible = [view.visible_region()]
+
+    def poll():
+        if view.is_valid() and is_shown(view) and refresh_clipped_regions(view):
+            current = view.visible_region()
+            if current != visible[0]:
+                visible[0] = current
+                state.idle = 0
+            else:
+                state.idle += 1
+            if state.idle < BH_CLIP_IDLE_POLLS:
+                sublime.set_timeout(poll, BH_CLIP_POLL)
+                return
+        state.watching = False
+
+    sublime.set_timeout(poll, BH_CLIP_POLL)
+
+
+def check_clipped_regions(view):
+    """Redraw clipped regions that have scrolled into view, and watch the viewport for a while, as the view is used."""
+
+    if refresh_clipped_regions(view):
+        watch_clipped_regions(view)
+
+
+class ContentBar(object):
+    """
+    Content bar of a multi-line block.
+
+    The start of each line of the block is found with one pass over the buffer.
+    Where the bar is drawn on a line is only calculated when the line is drawn.
+    """
+
+    def __init__(self, bfr, left, right, lines, tab_size, align):
+        """Find the lines of the block."""
+
+        self.bfr = bfr
+        self.bracket_locations = (left.begin, right.begin)
+        self.right = right.begin
+        self.tab_size = tab_size
+        self.align = align
+        self.bars = {}
+
+        # Starts of the lines after the first, and of the line after the block
+        first_start = bfr.rfind('\n', 0, left.begin) + 1
+        self.starts = []
+        pt = first_start
+        for _ in range(lines):
+            pt = bfr.find('\n', pt) + 1
+            if not pt:
+                break
+            self.starts.append(pt)
+        if len(self.starts) == lines:
+            self.next_start = self.starts.pop()
+        else:
+            self.next_start = len(bfr) + 1
+        self.last = lines - 2
+
+        if align:
+            self.index, self.count = self.get_column(first_start, left.end)
+
+    def __eq__(self, other):
+        """Compare content bars."""
+
+        return (
+            isinstance(other, ContentBar) and
+            self.bfr is other.bfr and
+            self.bracket_locations == other.bracket_locations and
+            self.starts == other.starts and
+            self.align == other.align and
+            self.tab_size == other.tab_size
+        )
+
+    def get_column(self, start_pt, end_pt):
+        """Calculate column index of where text starts for the line containing the opening bracket."""
+
+        tab_size = self.tab_size
+        index = 0
+        tabs = 0
+        count = 0
+        for char in self.bfr[start_pt:start_pt + end_pt]:
+            if char == "\t":
+                # Track all tabs
+                tabs += 1
+            elif char != " ":
+                # Calculate column on first non-whitespace character
+                remainder = count % tab_size
+                tab_aligned = int(count / tab_size)
+                if remainder and tabs:
+                    # Index of first non-whitespace character.
+                    # Account for smaller tabs that are not aligned on
+                    # tab_size boundary.
+                    index = tab_aligned + (tabs * (tab_size - 1)) + tab_size
+                else:
+                    # Index of first non-whitespace character.
+                    # Spaces and full tabs aligned on tab_size boundaries
+                    index = count + (tabs * (tab_size - 1))
+                break
+            count += 1
+        return index, count
+
+    def get_aligned_pt(self, start_pt):
+        """
+        Calculate the true column position where the bar should be drawn on the line.
+
+        Calculation should account for tabs.  `None` is returned if text comes before the bar.
+        """
+
+        tab_size = self.tab_size
+        end_pt = start_pt + self.index
+        actual_pt = start_pt - 1
+        offset = 0
+        tab_unit = 0
+        bfr = self.bfr
+        for i in range(start_pt, min(len(bfr), start_pt + end_pt)):
+            char = bfr[i]
+            if char == '\x00':
+                # Extended past the file's end
+                actual_pt += 1
+                break
+            elif char == "\t":
+                # Tab will expand to the rest of the tab_size.
+                # Track columns that are consumed by tabs.
+                offset += tab_size - 1 - tab_unit
+                tab_unit = tab_size
+                actual_pt += 1
+            elif char == " ":
+                # Normal space.
+                # Track columns consumed by spaces in relation to tab_size.
+                actual_pt += 1
+                tab_unit += 1
+            elif (actual_pt + 1 + offset) < end_pt:
+                # Do not draw bar if text comes before bar
+                return None
+            if tab_unit == tab_size:
+                # Roll over tab_unit
+                tab_unit = 0
+            if (actual_pt + offset) >= end_pt:
+                # Reached the target point.
+                break
+        return actual_pt
+
+    def get_bar(self, line):
+        """Get where the bar is drawn on a line of the block, if it is drawn."""
+
+        start_pt = self.starts[line]
+        if self.align:
+            pt = self.get_aligned_pt(start_pt)
+            next_start = self.starts[line + 1] if line + 1 < len(self.starts) else self.next_start
+            if (
+                pt is None or (pt - start_pt) + 1 <= self.count or pt >= self.right or
+                not start_pt <= pt < next_start
+            ):
+                return None
+        else:
+            pt = start_pt
+        if pt in self.bracket_locations:
+            return None
+        # Draw bar on last line only if text comes before bracket
+        if line == self.last and not self.bfr[pt:self.right].strip(' \t'):
+            return None
+        return pt
+
+    def get_regions(self, begin, end):
+        """Get the bar's regions on the lines that start within the window."""
+
+        first = bisect_left(self.starts, begin)
+        last = bisect_left(self.starts, end)
+        r = []
+        for line in range(first, last):
+            pt = self.bars.get(line, False)
+            if pt is False:
+                pt = self.get_bar(line)
+                self.bars[line] = pt
+            if pt is not None:
+                r.append(sublime.Region(pt))
+        return r, first > 0 or last < len(self.starts)
+
+
+def forget_drawn_regions(view_id):
+    """Forget the regions drawn in a view."""
+
+    state = bh_state.view_states.get(view_id)
+    if state is not None:
+        state.regions = None
+        state.locations = bh_state.BracketLocations()
+        state.update = None
+        state.clip = None
 
 
 def clear_all_regions():
     """Clear all regions."""
 
+    bh_state.clear_view_states()
     for window in sublime.windows():
         for view in window.views():
             # Normal views
             for region_key in view.settings().get("bracket_highlighter.regions", []):
                 view.erase_regions(region_key)
-            view.settings().set(
-                'bracket_highlighter.locations', {'open': {}, 'close': {}, 'unmatched': {}, 'icon': {}}
-            )
+            # Locations used to be stored in the view's settings
+            view.settings().erase('bracket_highlighter.locations')
 
 
 def select_bracket_style(option, minimap):
@@ -189,6 +483,101 @@ class StyleDefinition(object):
         self.content_selections = []
 
 
+class RegionUpdate(object):
+    """
+    Regions and selections to apply to a view.
+
+    Updates are prepared ahead of time so matching can be done
+    on a different thread than the one that draws the regions.
+    """
+
+    def __init__(self, sels, alter_select, multi_select, locations, status, clip_to_viewport=True, change_count=None):
+        """Setup the update, `change_count` is that of the buffer the regions were matched from."""
+
+        self.change_count = change_count
+        self.sels = sels
+        self.alter_select = alter_select
+        self.multi_select = multi_select
+        self.locations = locations
+        self.status = status
+        self.clip_to_viewport = clip_to_viewport
+        self.regions = []
+
+    def add_regions(self, name, regions, color, icon, flags):
+        """Add a highlight region to draw."""
+
+        # Copy the regions as they are compared against the next update once drawn
+        self.regions.append((name, list(regions), color, icon, flags))
+
+    def change_sel(self, view):
+        """Change the view's selections."""
+
+        if self.alter_select and len(self.sels) > 0:
+            if self.multi_select is False:
+                view.show(self.sels[0])
+            view.sel().clear()
+            view.sel().add_all(self.sels)
+
+    def apply(self, view):
+        """Apply the update to the view."""
+
+        self.change_sel(view)
+        self.draw(view)
+
+        if self.status is not None:
+            sublime.status_message(self.status)
+
+    def draw(self, view):
+        """
+        Draw the update's regions in the view.
+
+        Only regions that differ from what was last drawn in the view are redrawn.
+        Spans and content bars are only drawn near the visible region, the update is kept
+        so they can be redrawn when the view is scrolled.
+        """
+
+        regions_key = "bracket_highlighter.regions"
+        state = bh_state.get_view_state(view.id())
+
+        window = get_draw_window(view, self.clip_to_viewport)
+        clip = False
+        current = {}
+        for name, selections, color, icon, flags in self.regions:
+            selections, clipped = expand_regions(selections, *window)
+            clip = clip or clipped
+            if selections:
+                current[name] = (selections, color, icon, flags)
+
+        previous = state.regions
+        if previous is None:
+            # We don't know what is drawn, so clear everything we've tracked.
+            # Sometimes Sublime is in a weird state and returns None instead of the default we ask for
+            highlight_regions = view.settings().get(regions_key, [])
+            if highlight_regions is not None:
+                for region_key in highlight_regions:
+                    view.erase_regions(region_key)
+            previous = {}
+        else:
+            for name in previous:
+                if name not in current:
+                    view.erase_regions(name)
+
+        for name, entry in current.items():
+            if previous.get(name) != entry:
+                view.add_regions(name, *entry)
+
+        if previous != current or state.regions is None:
+            # Track which regions were set in the view so that they can be cleaned up later,
+            # even if the plugin is reloaded.
+            view.settings().set(regions_key, list(current.keys()))
+        state.regions = current
+        state.locations = self.locations
+        state.update = self if clip else None
+        state.clip = window if clip else None
+        if clip:
+            watch_clipped_regions(view)
+
+
 class BhRegion(object):
     """Class for handling highlight regions."""
 
@@ -197,14 +586,14 @@ class BhRegion(object):
 
         settings = sublime.load_settings("bh_core.sublime-settings")
         minimap = settings.get('show_in_minimap', False)
-        self.log_regions = {'open': {}, 'close': {}, 'unmatched': {}, 'icon': {}}
-        self.log_count = 0
+        self.locations = bh_state.BracketLocations()
         self.count_lines = count_lines
         self.hv_style = select_bracket_style(settings.get("high_visibility_style", "outline"), minimap)
         self.hv_underline = self.hv_style & sublime.DRAW_EMPTY_AS_OVERWRITE
         self.hv_color = settings.get("high_visibility_color", HV_RSVD_VALUES[1])
         self.no_multi_select_icons = bool(settings.get("no_multi_select_icons", False))
         self.gutter_icons = bool(settings.get("gutter_icons", True))
+        self.clip_to_viewport = bool(settings.get("viewport_clipped_regions", True))
         self.bracket_regions = {}
         self.alter_select = alter_select
         for style, bracket_region in get_bracket_regions(settings, minimap):
@@ -245,8 +634,7 @@ class BhRegion(object):
         self.multi_select = num_sels > 1
         self.sels = []
         self.view = view
-        self.log_regions = {'open': {}, 'close': {}, 'unmatched': {}, 'icon': {}}
-        self.log_count = 0
+        self.locations = bh_state.BracketLocations()
 
         for r in self.bracket_regions.values():
             r.clear()
@@ -258,15 +646,6 @@ class BhRegion(object):
             for region in regions:
                 self.sels.append(region)
 
-    def change_sel(self):
-        """Change the view's selections."""
-
-        if self.alter_select and len(self.sels) > 0:
-            if self.multi_select is False:
-                self.view.show(self.sels[0])
-            self.view.sel().clear()
-            self.view.sel().add_all(self.sels)
-
     def save_incomplete_regions(self, left, right, regions):
         """Store single incomplete brackets for highlighting."""
 
@@ -276,8 +655,20 @@ class BhRegion(object):
             bracket.selections += underline((found.toregion(),))
         else:
             bracket.selections += [found.toregion()]
-        self.log_regions['unmatched'][str(self.log_count + 1)] = (found.begin, found.end)
-        self.log_count += 1
+        self.locations.add_unmatched((found.begin, found.end))
+        self.store_sel(regions)
+
+    def save_unresolved_regions(self, sel, regions):
+        """Store the cursor of a selection whose match ran out of time."""
+
+        pt = sel.b
+        found = sublime.Region(pt, pt + 1) if pt < self.view.size() else sublime.Region(max(0, pt - 1), pt)
+        bracket = self.bracket_regions["unresolved"]
+        if bracket.underline:
+            bracket.selections += underline((found,))
+        else:
+            bracket.selections += [found]
+        self.locations.add_unmatched((found.begin(), found.end()))
         self.store_sel(regions)
 
     def save_regions(self, left, right, regions, style, high_visibility):
@@ -316,122 +707,24 @@ class BhRegion(object):
         if sublime.load_settings("bh_core.sublime-settings").get("content_highlight_bar", False) and lines > 1:
             self.save_content_regions(left, right, bracket, lines)
 
-        begin_region = None if left is None else (left.begin, left.end)
-        end_region = None if right is None else (right.begin, right.end)
-        if begin_region:
-            self.log_regions['open'][str(self.log_count + 1)] = begin_region
-        if end_region:
-            self.log_regions['close'][str(self.log_count + 1)] = end_region
-        if begin_region or end_region:
-            self.log_regions['icon'][str(self.log_count + 1)] = (
-                bracket.icon,
-                self.get_color(bracket.color, high_visibility),
-            )
-            self.log_count += 1
+        self.locations.add_pair(
+            (left.begin, left.end),
+            (right.begin, right.end),
+            (bracket.icon, self.get_color(bracket.color, high_visibility))
+        )
 
         self.store_sel(regions)
 
     def save_content_regions(self, left, right, bracket, lines):
-        """Calculate content bar location and save region(s)."""
-
-        first_line = self.view.rowcol(left.begin)[0]
-        last_line = first_line + lines - 1
-        whitespace = (' ', '\t')
-        bracket_locations = (left.begin, right.begin)
-
-        if sublime.load_settings("bh_core.sublime-settings").get("align_content_highlight_bar", False):
-            start_pt = self.view.text_point(first_line, 0)
-            end_pt = left.end
-            tab_size = self.view.settings().get("tab_size", 4)
-            index = 0
-            tabs = 0
-            count = 0
-            # Calculate column index of where text starts for line
-            # containing opening bracket
-            for char in self.view.substr(sublime.Region(start_pt, start_pt + end_pt)):
-                if char == "\t":
-                    # Track all tabs
-                    tabs += 1
-                elif char != " ":
-                    # Calculate column on first non-whitespace character
-                    remainder = count % tab_size
-                    tab_aligned = int(count / tab_size)
-                    if remainder and tabs:
-                        # Index of first non-whitespace character.
-                        # Account for smaller tabs that are not aligned on
-                        # tab_size boundary.
-                        index = tab_aligned + (tabs * (tab_size - 1)) + tab_size
-                    else:
-                        # Index of first non-whitespace character.
-                        # Spaces and full tabs aligned on tab_size boundaries
-                        index = count + (tabs * (tab_size - 1))
-                    break
-                count += 1
+        """Save the content bar of the block, the bar's regions are computed as they are drawn."""
 
-            for x in range(first_line + 1, first_line + lines):
-                start_pt = self.view.text_point(x, 0)
-                end_pt = start_pt + index
-                actual_pt = start_pt - 1
-                offset = 0
-                tab_unit = 0
-                include = True
-
-                # Loop through all lines after the first.
-                # Calculate the true column position where the bar should
-                # be drawn.  Calculation should account for tabs.
-                for char in self.view.substr(sublime.Region(start_pt, start_pt + end_pt)):
-                    if char == '\x00':
-                        # Extended past the file's end
-                        actual_pt += 1
-                        break
-                    elif char == "\t":
-                        # Tab will expand to the rest of the tab_size.
-                        # Track columns that are consumed by tabs.
-                        offset += tab_size - 1 - tab_unit
-                        tab_unit = tab_size
-                        actual_pt += 1
-                    elif char == " ":
-                        # Normal space.
-                        # Track columns consumed by spaces in relation to tab_size.
-                        actual_pt += 1
-                        tab_unit += 1
-                    elif (actual_pt + 1 + offset) < end_pt:
-                        # Do not draw bar if text comes before bar
-                        include = False
-                        break
-                    if tab_unit == tab_size:
-                        # Roll over tab_unit
-                        tab_unit = 0
-                    if (actual_pt + offset) >= end_pt:
-                        # Reached the target point.
-                        break
-                if include and (actual_pt - start_pt) + 1 > count and actual_pt < right.begin:
-                    if self.view.rowcol(actual_pt)[0] == x and actual_pt not in bracket_locations:
-                        if x == last_line:
-                            # Draw bar on last line if text comes before bracket
-                            if any(
-                                char not in whitespace
-                                for char in self.view.substr(sublime.Region(actual_pt, right.begin))
-                            ):
-                                bracket.content_selections.append(sublime.Region(actual_pt))
-                        else:
-                            # Content line; draw bar
-                            bracket.content_selections.append(sublime.Region(actual_pt))
-        else:
-            # Loop through all lines after the first, draw a bar
-            for x in range(first_line + 1, first_line + lines):
-                pt = self.view.text_point(x, 0)
-                if pt not in bracket_locations:
-                    if x == last_line:
-                        # Draw bar on last line if text comes before bracket
-                        if any(
-                            char not in whitespace
-                            for char in self.view.substr(sublime.Region(pt, right.begin))
-                        ):
-                            bracket.content_selections.append(sublime.Region(pt))
-                    else:
-                        # Content line; draw bar
-                        bracket.content_selections.append(sublime.Region(pt))
+        align = sublime.load_settings("bh_core.sublime-settings").get("align_content_highlight_bar", False)
+        bracket.content_selections.append(
+            ContentBar(
+                bh_buffer.get_snapshot(self.view).text, left, right, lines,
+                self.view.settings().get("tab_size", 4), align
+            )
+        )
 
     def save_high_visibility_regions(self, left, right, bracket, lines):
         """Save high visibility regions."""
@@ -440,13 +733,13 @@ class BhRegion(object):
             if self.hv_underline:
                 bracket.selections += underline((sublime.Region(left.begin, right.end),))
             else:
-                bracket.selections += [sublime.Region(left.begin, right.end)]
+                bracket.selections += [ClippedSpan(left.begin, right.end)]
         else:
             bracket.open_selections += [sublime.Region(left.begin)]
             if self.hv_underline:
                 bracket.center_selections += underline((sublime.Region(left.begin + 1, right.end - 1),))
             else:
-                bracket.center_selections += [sublime.Region(left.begin, right.end)]
+                bracket.center_selections += [ClippedSpan(left.begin, right.end)]
             bracket.close_selections += [sublime.Region(right.begin)]
 
     def save_endpoint_regions(self, left, right, bracket, lines):
@@ -492,12 +785,12 @@ class BhRegion(object):
             bracket.open_selections += [left.toregion()]
             bracket.close_selections += [right.toregion()]
 
-    def highlight_regions(self, name, icon_type, selections, bracket, regions, high_visibility):
-        """Apply the highlights for the highlight region."""
+    def highlight_regions(self, name, icon_type, selections, bracket, update, high_visibility):
+        """Add the highlights for the highlight region to the update."""
 
         if len(selections):
             if selections == "content_selections":
-                self.view.add_regions(
+                update.add_regions(
                     name,
                     getattr(bracket, selections) if not high_visibility else [],
                     self.get_color(bracket.color, False),
@@ -505,34 +798,24 @@ class BhRegion(object):
                     sublime.DRAW_EMPTY
                 )
             else:
-                self.view.add_regions(
+                update.add_regions(
                     name,
                     getattr(bracket, selections),
                     self.get_color(bracket.color, high_visibility),
                     getattr(bracket, icon_type),
                     self.hv_style if high_visibility else bracket.style
                 )
-            regions.append(name)
 
-    def highlight(self, high_visibility):
-        """Highlight all bracket regions."""
+    def prepare(self, high_visibility):
+        """Prepare the update of all bracket regions."""
 
-        self.change_sel()
-
-        # Sometimes Sublime is in a weird state and returns None instead of the default we ask for
-        regions_key = "bracket_highlighter.regions"
-        locations_key = "bracket_highlighter.locations"
-        highlight_regions = self.view.settings().get(regions_key, [])
-        if highlight_regions is not None:
-            for region_key in highlight_regions:
-                self.view.erase_regions(region_key)
-
-        # Clear regions
-        self.view.settings().set(
-            'bracket_highlighter.locations', {'open': {}, 'close': {}, 'unmatched': {}, 'icon': {}}
+        update = RegionUpdate(
+            self.sels, self.alter_select, self.multi_select, self.locations,
+            'In Block: Lines ' + str(self.lines) + ', Chars ' + str(self.chars) if self.count_lines else None,
+            self.clip_to_viewport,
+            self.view.change_count()
         )
 
-        regions = []
         icon_type = "no_icon"
         open_icon_type = "no_icon"
         close_icon_type = "no_icon"
@@ -542,23 +825,23 @@ class BhRegion(object):
             close_icon_type = "small_close_icon" if self.view.line_height() < 16 else "close_icon"
         for name, r in self.bracket_regions.items():
             self.highlight_regions(
-                "bh_" + name, icon_type, "selections", r, regions, high_visibility
+                "bh_" + name, icon_type, "selections", r, update, high_visibility
             )
             self.highlight_regions(
-                "bh_" + name + "_center", "no_icon", "center_selections", r, regions, high_visibility
+                "bh_" + name + "_center", "no_icon", "center_selections", r, update, high_visibility
             )
             self.highlight_regions(
-                "bh_" + name + "_open", open_icon_type, "open_selections", r, regions, high_visibility
+                "bh_" + name + "_open", open_icon_type, "open_selections", r, update, high_visibility
             )
             self.highlight_regions(
-                "bh_" + name + "_close", close_icon_type, "close_selections", r, regions, high_visibility
+                "bh_" + name + "_close", close_icon_type, "close_selections", r, update, high_visibility
             )
             self.highlight_regions(
-                "bh_" + name + "_content", "no_icon", "content_selections", r, regions, high_visibility
+                "bh_" + name + "_content", "no_icon", "content_selections", r, update, high_visibility
             )
-        # Track which regions were set in the view so that they can be cleaned up later.
-        self.view.settings().set(regions_key, regions)
-        self.view.settings().set(locations_key, self.log_regions)
+        return update
 
-        if self.count_lines:
-            sublime.status_message('In Block: Lines ' + str(self.lines) + ', Chars ' + str(self.chars))
+    def highlight(self, high_visibility):
+        """Highlight all bracket regions."""
+
+        self.prepare(high_visibility).apply(self.view)
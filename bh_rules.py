@@ -6,8 +6,10 @@ License: MIT
 """
 from backrefs import bre
 from . import bh_plugin
+from . import bh_tokens
 from .bh_logging import debug, log
 from operator import itemgetter
+from collections import OrderedDict
 import sublime
 import sublime_plugin
 
@@ -25,6 +27,16 @@ BH_SCOPE_EXCLUDE = []
 BH_SCOPE_EXCLUDE_EXCEPTIONS = []
 BH_IGNORE_STRING_ESCAPE = False
 BH_PLUGIN_LIB = None
+BH_RULE_CACHE_SIZE = 16
+
+# Loaded rules shared by all views and matchers.
+# They are keyed by language, settings revision, and adjacency modes.
+RULE_STATE = (
+    'enabled', 'brackets', 'scopes', 'pattern', 'scanner', 'sub_pattern',
+    'check_compare', 'check_validate', 'check_post_match', 'highlighting'
+)
+rule_cache = OrderedDict()
+rule_revision = 0
 
 SCOPE_ERROR = '''ERROR: Scope rule '%s' has an invalid number of regex capturing groups!
 REGEX:
@@ -36,6 +48,14 @@ REGEX: %s
 '''
 
 
+def bump_rule_revision():
+    """Settings have changed, so rules loaded before now are stale."""
+
+    global rule_revision
+    rule_revision += 1
+    rule_cache.clear()
+
+
 def exclude_bracket(enabled, filter_type, language_list, language):
     """Exclude or include brackets based on filter lists."""
 
@@ -149,6 +169,9 @@ class BracketDefinition(object):
         self.scope_exclude_exceptions = bracket.get("scope_exclude_exceptions", BH_SCOPE_EXCLUDE_EXCEPTIONS)
         self.scope_exclude = bracket.get("scope_exclude", BH_SCOPE_EXCLUDE)
         self.ignore_string_escape = bracket.get("ignore_string_escape", BH_IGNORE_STRING_ESCAPE)
+        # Selectors are joined once so scope checks can be memoized by selector
+        self.scope_exclude_exceptions_selector = ", ".join(self.scope_exclude_exceptions)
+        self.scope_exclude_selector = ", ".join(self.scope_exclude)
 
 
 class ScopeDefinition(object):
@@ -192,9 +215,26 @@ class SearchRules(object):
         self.block_cursor = block_cursor
         self.sub_pattern = None
         self.pattern = None
+        self.scanner = None
+        # Revision of the settings the rules were loaded from
+        self.revision = None
 
     def load_rules(self, language, modules):
-        """Load the search rules."""
+        """
+        Load the search rules.
+
+        Rules that were already loaded for the language are reused.
+        Returns `True` if the rules had to be built.
+        """
+
+        key = (language, rule_revision, self.outside_adj, self.block_cursor)
+        self.revision = rule_revision
+        state = rule_cache.get(key)
+        if state is not None:
+            rule_cache.move_to_end(key)
+            for name, value in zip(RULE_STATE, state):
+                setattr(self, name, value)
+            return False
 
         self.enabled = False
         self.brackets = []
@@ -208,6 +248,11 @@ class SearchRules(object):
         if len(self.scopes) or len(self.brackets):
             self.enabled = True
 
+        rule_cache[key] = tuple(getattr(self, name) for name in RULE_STATE)
+        while len(rule_cache) > BH_RULE_CACHE_SIZE:
+            rule_cache.popitem(last=False)
+        return True
+
     def parse_bracket_definition(self, language, loaded_modules):
         """Parse the bracket definition."""
 
@@ -217,6 +262,7 @@ class SearchRules(object):
         sub_find_regex = []
         self.sub_pattern = None
         self.pattern = None
+        self.scanner = None
 
         for params in self.bracket_rules:
             if is_valid_definition(params, language):
@@ -295,6 +341,8 @@ class SearchRules(object):
                 self.brackets = []
                 self.sub_pattern = None
                 self.pattern = None
+            else:
+                self.scanner = bh_tokens.BracketScanner(self.pattern, find_regex)
 
     def parse_scope_definition(self, language, loaded_modules):
         """Parse the scope definition."""
@@ -496,3 +544,18 @@ class BhDebugRuleCommand(sublime_plugin.WindowCommand):
         """See if command is enabled."""
 
         return sublime.load_settings("bh_core.sublime-settings").get('debug_enable', False)
+
+
+def plugin_loaded():
+    """Track changes to the settings rules are loaded from."""
+
+    settings = sublime.load_settings("bh_core.sublime-settings")
+    settings.clear_on_change('rules_reload')
+    settings.add_on_change('rules_reload', bump_rule_revision)
+
+
+def plugin_unloaded():
+    """Stop tracking settings changes."""
+
+    sublime.load_settings("bh_core.sublime-settings").clear_on_change('rules_reload')
+    rule_cache.clear()
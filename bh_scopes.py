@@ -0,0 +1,144 @@
+"""
+BracketHighlighter.
+
+Copyright (c) 2013 - 2017 Isaac Muse <isaacmuse@gmail.com>
+License: MIT
+
+Scope maps sampled from a view.
+"""
+import sublime
+from bisect import bisect_left, bisect_right
+
+
+class StaleScopes(BaseException):
+    """
+    Raised when scopes are sampled from a view that has changed since its scope map was made.
+
+    The scopes would no longer fit the text being matched, so the match is abandoned.
+    Like `MatchTimeout`, it doesn't derive from `Exception`, so plugin hooks don't stop it.
+    """
+
+
+class ScopeMap(object):
+    """
+    Scopes of a view sampled as runs of text.
+
+    Sampling a range is done with one call, so scopes can later be queried without
+    going back to the view.  Points that were not sampled fall back to asking the view.
+    Only the view at the change count the map was made for is sampled.
+    """
+
+    def __init__(self, view, change_count=None):
+        """Setup the scope map."""
+
+        self.view = view
+        self.change_count = view.change_count() if change_count is None else change_count
+        self.starts = []
+        self.ends = []
+        self.scopes = []
+        self.covered = []
+        self.names = {}
+        self.scores = {}
+        # Extents of scope brackets, per scope selector
+        self.extents = {}
+
+    def get_gaps(self, begin, end):
+        """Get the parts of the range that have not been sampled."""
+
+        gaps = []
+        for covered_begin, covered_end in self.covered:
+            if covered_end <= begin:
+                continue
+            if covered_begin >= end:
+                break
+            if covered_begin > begin:
+                gaps.append((begin, covered_begin))
+            begin = max(begin, covered_end)
+        if begin < end:
+            gaps.append((begin, end))
+        return gaps
+
+    def check_current(self):
+        """Raise `StaleScopes` if the view has changed since the map was made."""
+
+        if self.view.change_count() != self.change_count:
+            raise StaleScopes()
+
+    def sample(self, begin, end):
+        """
+        Sample the scopes of a range of the view that has not been sampled yet.
+
+        Raises `StaleScopes` if the view changed before the scopes were sampled.
+        """
+
+        gaps = self.get_gaps(begin, end)
+        if not gaps:
+            return
+
+        self.check_current()
+        sampled = [self.view.extract_tokens_with_scopes(sublime.Region(*gap)) for gap in gaps]
+        # The view can change on the main thread while it is sampled
+        self.check_current()
+        for runs in sampled:
+            if not runs:
+                continue
+            # Runs of a gap are in order, so they are spliced in over any runs they start on
+            first = bisect_left(self.starts, runs[0][0].begin())
+            last = bisect_right(self.starts, runs[-1][0].begin())
+            self.starts[first:last] = [region.begin() for region, scope in runs]
+            self.ends[first:last] = [region.end() for region, scope in runs]
+            self.scopes[first:last] = [scope for region, scope in runs]
+
+        covered = []
+        for covered_begin, covered_end in sorted(self.covered + gaps):
+            if covered and covered_begin <= covered[-1][1]:
+                covered[-1] = (covered[-1][0], max(covered[-1][1], covered_end))
+            else:
+                covered.append((covered_begin, covered_end))
+        self.covered = covered
+
+    def scope_name(self, pt):
+        """Get the scope name at the given point."""
+
+        index = bisect_right(self.starts, pt) - 1
+        if index >= 0 and pt < self.ends[index]:
+            return self.scopes[index]
+        scope = self.names.get(pt)
+        if scope is None:
+            scope = self.view.scope_name(pt)
+            self.check_current()
+            self.names[pt] = scope
+        return scope
+
+    def score_selector(self, pt, selector):
+        """Score the selector against the scope at the given point."""
+
+        return self.score_scope(self.scope_name(pt), selector)
+
+    def score_scope(self, scope, selector):
+        """Score the selector against a scope name, scores are remembered per scope name."""
+
+        key = (scope, selector)
+        score = self.scores.get(key)
+        if score is None:
+            score = sublime.score_selector(scope, selector)
+            self.scores[key] = score
+        return score
+
+    def match_selector(self, pt, selector):
+        """Check if the selector matches the scope at the given point."""
+
+        return self.score_selector(pt, selector) > 0
+
+
+def sample_windows(view, points, threshold):
+    """Sample the scopes around the given points."""
+
+    scope_map = ScopeMap(view)
+    size = view.size()
+    for pt in points:
+        if threshold is None:
+            scope_map.sample(0, size)
+            break
+        scope_map.sample(max(0, pt - threshold), min(size, pt + threshold))
+    return scope_map
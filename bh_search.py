@@ -5,7 +5,11 @@ Copyright (c) 2013 - 2016 Isaac Muse <isaacmuse@gmail.com>
 License: MIT
 """
 import sublime
+from bisect import bisect_right
 from collections import namedtuple
+from . import bh_buffer
+from . import bh_plugin
+from . import bh_tokens
 
 BH_SEARCH_LEFT = 0
 BH_SEARCH_RIGHT = 1
@@ -13,6 +17,10 @@ BH_SEARCH_OPEN = 0
 BH_SEARCH_CLOSE = 1
 BH_ADJACENT_LEFT = 0
 BH_ADJACENT_RIGHT = 1
+# Size of the first chunk scanned on either side of the cursor, later chunks double in size.
+BH_SCAN_CHUNK = 512
+# Size of the chunks the whole buffer is gathered in when every bracket is needed.
+BH_BUFFER_CHUNK = 65536
 
 
 class BhEntry(object):
@@ -49,50 +57,174 @@ class ScopeEntry(namedtuple('ScopeEntry', ['begin', 'end', 'scope', 'type']), Bh
 class Search(object):
     """Search buffer object."""
 
-    def __init__(self, view, rules, sel, selection_threshold=None):
-        """Read in the view's buffer for scanning for brackets etc."""
+    def __init__(self, view, rules, sel, selection_threshold=None, snapshot=None):
+        """
+        Read in the view's buffer for scanning for brackets etc.
+
+        A buffer snapshot can be passed in so multiple searches can share the same copy.
+        """
 
         self.rules = rules
 
         self.view = view
         # Determine how much of the buffer to search
+        self.pt = sel.a
+        self.view_size = view.size()
+        self.threshold = selection_threshold
+        search_window = self.get_search_window(selection_threshold)
+
+        # Search Buffer
+        if snapshot is None:
+            snapshot = bh_buffer.get_snapshot(view)
+        self.snapshot = snapshot
+        self.bfr = snapshot.text
+        self.scope_map = None
+        self.set_search_window(search_window)
+
+    def get_buffer(self):
+        """Get view buffer."""
+
+        return self.bfr
+
+    def get_search_window(self, selection_threshold):
+        """Get the window of the buffer to search for the given threshold."""
+
         view_min = 0
-        view_max = view.size()
+        view_max = self.view_size
         if selection_threshold is not None:
-            left_delta = sel.a - view_min
-            right_delta = view_max - sel.a
+            left_delta = self.pt - view_min
+            right_delta = view_max - self.pt
             limit = selection_threshold / 2
             rpad = limit - left_delta if left_delta < limit else 0
             lpad = limit - right_delta if right_delta < limit else 0
             llimit = limit + lpad
             rlimit = limit + rpad
             search_window = (
-                sel.a - llimit if left_delta >= llimit else view_min,
-                sel.a + rlimit if right_delta >= rlimit else view_max
+                self.pt - llimit if left_delta >= llimit else view_min,
+                self.pt + rlimit if right_delta >= rlimit else view_max
             )
         else:
             search_window = (0, view_max)
+        return search_window
 
-        # Search Buffer
-        self.bfr = view.substr(sublime.Region(0, view_max))
-        self.set_search_window(search_window)
+    def grow_search_window(self):
+        """
+        Double the search threshold and widen the search window.
 
-    def get_buffer(self):
-        """Get view buffer."""
+        Returns `False` if the window already covers the whole buffer.
+        """
 
-        return self.bfr
+        if self.threshold is None or (self.search_window[0] <= 0 and self.search_window[1] >= self.view_size):
+            return False
+        self.threshold *= 2
+        self.set_search_window(self.get_search_window(self.threshold))
+        return True
 
     def set_search_window(self, search_window):
         """Set the window of search in the buffer."""
 
         self.search_window = search_window
 
+    def get_tokens(self, begin, end, limit=None):
+        """
+        Get the bracket tokens of the main pattern within the given range.
+
+        If a limit is given, tokens that start within the range and end before the limit are returned.
+        """
+
+        return self.get_token_index().get_tokens(self.bfr, self.snapshot.change_count, begin, end, limit)
+
+    def touches_tokens(self, begin, end):
+        """Check if any bracket token of the main pattern overlaps or touches the given range."""
+
+        return self.get_token_index().touches(self.bfr, self.snapshot.change_count, begin, end)
+
+    def get_token_index(self):
+        """Get the buffer's token index, views of a snapshot bring their own."""
+
+        return bh_tokens.get_token_index(
+            self.snapshot.buffer_id, self.rules.scanner, getattr(self.view, 'token_indexes', None)
+        )
+
+    def get_scope_map(self):
+        """Get the scope map, it is shared with every search of the same snapshot."""
+
+        if self.scope_map is None:
+            scope_map = getattr(self.view, 'scope_map', None)
+            if scope_map is None:
+                scope_map = self.snapshot.get_scope_map(self.view)
+            self.scope_map = scope_map
+        return self.scope_map
+
+    def sample_scopes(self, begin, end):
+        """Sample the scopes of a range with one call if any bracket excludes scopes."""
+
+        if any(bracket.scope_exclude_selector for bracket in self.rules.brackets):
+            self.get_scope_map().sample(begin, end)
+
+    def is_excluded_scope(self, pt, bracket):
+        """Check if the bracket at pt X is in a scope the bracket excludes."""
+
+        if not bracket.scope_exclude_selector:
+            return False
+        scope_map = self.get_scope_map()
+        if (
+            bracket.scope_exclude_exceptions_selector and
+            scope_map.match_selector(pt, bracket.scope_exclude_exceptions_selector)
+        ):
+            return False
+        return scope_map.match_selector(pt, bracket.scope_exclude_selector)
+
+    def get_brackets(self):
+        """
+        Get every bracket of the main pattern in the buffer that is not in an excluded scope.
+
+        The buffer is scanned and its scopes sampled a chunk at a time, so a search that runs
+        out of time stops without having gone through the whole buffer.
+        """
+
+        size = len(self.bfr)
+        for chunk_begin in range(0, size, BH_BUFFER_CHUNK):
+            bh_plugin.check_deadline()
+            chunk_end = min(size, chunk_begin + BH_BUFFER_CHUNK)
+            self.sample_scopes(chunk_begin, chunk_end)
+            for token in self.get_tokens(chunk_begin, chunk_end, size):
+                start, end, match_type, bracket_id = token[:4]
+                if not self.is_excluded_scope(start, self.rules.brackets[bracket_id]):
+                    yield BracketEntry(start, end, bracket_id), match_type
+
+    def match_scope(self, pt, selector):
+        """Check if the selector matches the scope at the given point."""
+
+        return self.get_scope_map().match_selector(pt, selector)
+
+    def get_scope_extent(self, pt, scope):
+        """Get the remembered extent of the scope that contains the point."""
+
+        extents = self.get_scope_map().extents.get(scope)
+        if extents:
+            index = bisect_right(extents, (pt, float('inf'))) - 1
+            if index >= 0 and pt < extents[index][1]:
+                return extents[index]
+        return None
+
+    def add_scope_extent(self, begin, end, grown, scope):
+        """Remember the extent of a scope, extents are kept with the scopes they were found from."""
+
+        extent = (begin, end, grown, self.get_buffer()[begin:end])
+        extents = self.get_scope_map().extents.setdefault(scope, [])
+        index = bisect_right(extents, (begin, float('inf')))
+        if not (index > 0 and extents[index - 1][:2] == (begin, end)):
+            extents.insert(index, extent)
+        return extent
+
     def new_scope_search(self, center, before_center, scope, adj_dir):
-        """Retrieve a new search object."""
+        """Retrieve a new search object, or `None` if the cursor is not in the scope."""
 
-        return ScopeSearch(
+        scope_search = ScopeSearch(
             self, center, before_center, scope, adj_dir
         )
+        return scope_search if scope_search.extent is not None else None
 
     def new_bracket_search(self, center, subsearch, scope):
         """Retrieve a new search object."""
@@ -109,32 +241,50 @@ class ScopeSearch(object):
         self.adjusted_center = center
         self.view = search.view
         self.search = search
-        extent = None
+        self.extent = None
+        self.scope_bfr = None
 
         if self.is_scope(center, before_center, scope, adj_dir):
-            if int(sublime.version()) >= 3067:
-                max_size = self.view.size()
+            cached = search.get_scope_extent(self.adjusted_center, scope)
+            if cached is None:
+                cached = self.find_extent(scope)
+            if cached is not None:
+                begin, end, grown, scope_bfr = cached
+                if not grown or (begin >= search.search_window[0] and end <= search.search_window[1]):
+                    self.extent = sublime.Region(begin, end)
+                    self.scope_bfr = scope_bfr
+
+    def find_extent(self, scope):
+        """Grow the extent of the scope at the adjusted center and remember it."""
+
+        search = self.search
+        if int(sublime.version()) >= 3067:
+            max_size = self.view.size()
+        else:
+            max_size = self.view.size() - 1
+        extent = self.view.extract_scope(self.adjusted_center)
+        if extent is None:
+            return None
+        grown = False
+        while extent.begin() != 0:
+            bh_plugin.check_deadline()
+            if search.match_scope(extent.begin() - 1, scope):
+                extent = extent.cover(self.view.extract_scope(extent.begin() - 1))
+                grown = True
+                if extent.begin() < search.search_window[0] or extent.end() > search.search_window[1]:
+                    return None
             else:
-                max_size = self.view.size() - 1
-            extent = self.view.extract_scope(self.adjusted_center)
-            while extent is not None and extent.begin() != 0:
-                if search.view.match_selector(extent.begin() - 1, scope):
-                    extent = extent.cover(self.view.extract_scope(extent.begin() - 1))
-                    if extent.begin() < search.search_window[0] or extent.end() > search.search_window[1]:
-                        extent = None
-                else:
-                    break
-            while extent is not None and extent.end() != max_size:
-                if self.view.match_selector(extent.end(), scope):
-                    extent = extent.cover(self.view.extract_scope(extent.end()))
-                    if extent.begin() < search.search_window[0] or extent.end() > search.search_window[1]:
-                        extent = None
-                else:
-                    break
-        assert extent is not None, "Failed to acquire scope buffer!"
-
-        self.extent = extent
-        self.scope_bfr = search.get_buffer()[extent.begin():extent.end()]
+                break
+        while extent.end() != max_size:
+            bh_plugin.check_deadline()
+            if search.match_scope(extent.end(), scope):
+                extent = extent.cover(self.view.extract_scope(extent.end()))
+                grown = True
+                if extent.begin() < search.search_window[0] or extent.end() > search.search_window[1]:
+                    return None
+            else:
+                break
+        return search.add_scope_extent(extent.begin(), extent.end(), grown, scope)
 
     def is_scope(self, center, before_center, scope, adj_dir=None):
         """Check if cursor is in scope or touching scope."""
@@ -146,21 +296,21 @@ class ScopeSearch(object):
             match_test = before_center >= 0
         if match_test:
             match = (
-                self.view.match_selector(center, scope) and
-                self.view.match_selector(before_center, scope)
+                self.search.match_scope(center, scope) and
+                self.search.match_scope(before_center, scope)
             )
         if not match and (self.search.rules.outside_adj or self.search.rules.block_cursor):
             if adj_dir == BH_ADJACENT_LEFT:
                 if self.search.rules.block_cursor:
-                    match = self.view.match_selector(center, scope)
+                    match = self.search.match_scope(center, scope)
                     if match:
                         self.adjusted_center += 1
                 elif before_center > 0 and not self.search.rules.block_cursor:
-                    match = self.view.match_selector(before_center, scope)
+                    match = self.search.match_scope(before_center, scope)
                     if match:
                         self.adjusted_center = before_center
             else:
-                match = self.view.match_selector(center, scope)
+                match = self.search.match_scope(center, scope)
                 if match:
                     self.adjusted_center += 1
         elif match and (self.search.rules.outside_adj or self.search.rules.block_cursor):
@@ -213,10 +363,16 @@ class BracketSearch(object):
         self.return_prev = [False, False]
         self.done = [False, False]
         self.start = [None, None]
+        # Brackets left of the cursor are stored nearest first, brackets to the right in buffer order.
         self.left = [[], []]
         self.right = [[], []]
         self.touch_left = False
         self.touch_right = False
+        self.window_start = int(search.search_window[0])
+        self.window_end = int(search.search_window[1])
+        self.scan_begin = self.window_start
+        self.scan_end = self.window_end
+        self.scan_size = [BH_SCAN_CHUNK, BH_SCAN_CHUNK]
         if self.pattern:
             self.findall()
 
@@ -239,13 +395,14 @@ class BracketSearch(object):
         escaped = False
         start = pt - 1
         first = False
+        bfr = self.search.get_buffer()
         if (
             self.search.view.settings().get(
                 "bracket_highlighter.bracket_string_escape_mode", self.search.rules.string_escape_mode
             ) == "string"
         ):
             first = True
-        while self.search.view.substr(start) == "\\":
+        while start >= 0 and bfr[start] == "\\":
             if first:
                 first = False
             else:
@@ -265,15 +422,7 @@ class BracketSearch(object):
             if self.escaped(pt, bracket.ignore_string_escape, scope):
                 illegal_scope = True
             return illegal_scope
-        # for exception in bracket.scope_exclude_exceptions:
-        elif (
-            len(bracket.scope_exclude_exceptions) and
-            self.search.view.match_selector(pt, ", ".join(bracket.scope_exclude_exceptions))
-        ):
-            pass
-        elif len(bracket.scope_exclude) and self.search.view.match_selector(pt, ", ".join(bracket.scope_exclude)):
-            illegal_scope = True
-        return illegal_scope
+        return self.search.is_excluded_scope(pt, bracket)
 
     def reset_end_state(self):
         """
@@ -374,25 +523,81 @@ class BracketSearch(object):
             self.right[match_type].append(BracketEntry(start, end, bracket_id))
 
     def findall(self):
-        """Find all of the brackets."""
+        """
+        Find the brackets around the cursor.
 
-        window_start = int(self.search.search_window[0])
-        window_end = int(self.search.search_window[1])
+        Sub-searches are small, so all of their brackets are found up front.
+        Otherwise, only the brackets near the cursor are found, and the rest of
+        the window is scanned outward in growing chunks as the brackets are requested.
+        """
 
-        for m in self.pattern.finditer(self.search.get_buffer(), window_start, window_end):
-            g = m.lastindex
-            try:
-                start = m.start(g)
-                end = m.end(g)
-            except Exception:
-                continue
+        if self.sub_search:
+            self.search.sample_scopes(self.window_start, self.window_end)
+            self.sort_tokens(
+                bh_tokens.decode_match(m)
+                for m in self.pattern.finditer(self.search.get_buffer(), self.window_start, self.window_end)
+            )
+        else:
+            self.scan_begin = max(self.window_start, self.center - BH_SCAN_CHUNK)
+            self.scan_end = min(self.window_end, self.center + BH_SCAN_CHUNK)
+            self.search.sample_scopes(self.scan_begin, self.scan_end)
+            # Normal searches use the buffer's token index which persists between matches.
+            self.sort_tokens(self.search.get_tokens(self.scan_begin, self.scan_end, self.window_end))
+
+        for match_type in (BH_SEARCH_OPEN, BH_SEARCH_CLOSE):
+            self.left[match_type].reverse()
 
-            match_type = int(not bool(g % 2))
-            bracket_id = int((g / 2) - match_type)
+    def sort_tokens(self, tokens):
+        """Sort the tokens that are not in an illegal scope."""
 
+        for token in tokens:
+            if token is None:
+                continue
+            start, end, match_type, bracket_id = token[:4]
             if not self.is_illegal_scope(start, bracket_id, self.scope):
                 self.bracket_sort(start, end, match_type, bracket_id)
 
+    def scan_left(self):
+        """
+        Scan the next chunk of the window left of what has been scanned.
+
+        Brackets found here start before everything that has been scanned,
+        so they are all left of the cursor.
+        """
+
+        if self.scan_begin <= self.window_start:
+            return False
+
+        stop = self.scan_begin
+        self.scan_begin = max(self.window_start, stop - self.scan_size[BH_SEARCH_LEFT])
+        self.scan_size[BH_SEARCH_LEFT] *= 2
+        self.search.sample_scopes(self.scan_begin, stop)
+        for token in reversed(self.search.get_tokens(self.scan_begin, stop, self.window_end)):
+            start, end, match_type, bracket_id = token[:4]
+            if not self.is_illegal_scope(start, bracket_id, self.scope):
+                self.left[match_type].append(BracketEntry(start, end, bracket_id))
+        return True
+
+    def scan_right(self):
+        """
+        Scan the next chunk of the window right of what has been scanned.
+
+        Brackets found here start after the cursor, so they are all right of the cursor.
+        """
+
+        if self.scan_end >= self.window_end:
+            return False
+
+        begin = self.scan_end
+        self.scan_end = min(self.window_end, begin + self.scan_size[BH_SEARCH_RIGHT])
+        self.scan_size[BH_SEARCH_RIGHT] *= 2
+        self.search.sample_scopes(begin, self.scan_end)
+        for token in self.search.get_tokens(begin, self.scan_end, self.window_end):
+            start, end, match_type, bracket_id = token[:4]
+            if not self.is_illegal_scope(start, bracket_id, self.scope):
+                self.right[match_type].append(BracketEntry(start, end, bracket_id))
+        return True
+
     def get_open(self, bracket_code):
         """
         Get opening bracket.
@@ -435,20 +640,21 @@ class BracketSearch(object):
             self.return_prev[match_type] = False
             yield self.prev_match[match_type]
         if bracket_code == BH_SEARCH_LEFT:
-            if self.start[match_type] is None:
-                self.start[match_type] = len(self.left[match_type])
-            for x in reversed(range(0, self.start[match_type])):
-                b = self.left[match_type][x]
-                self.prev_match[match_type] = b
-                self.start[match_type] -= 1
-                yield b
+            brackets = self.left[match_type]
+            scan = self.scan_left
         else:
-            if self.start[match_type] is None:
-                self.start[match_type] = 0
-            for x in range(self.start[match_type], len(self.right[match_type])):
-                b = self.right[match_type][x]
+            brackets = self.right[match_type]
+            scan = self.scan_right
+
+        if self.start[match_type] is None:
+            self.start[match_type] = 0
+        while True:
+            while self.start[match_type] < len(brackets):
+                b = brackets[self.start[match_type]]
                 self.prev_match[match_type] = b
                 self.start[match_type] += 1
                 yield b
+            if not scan():
+                break
 
         self.done[match_type] = True
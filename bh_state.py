@@ -0,0 +1,186 @@
+"""
+BracketHighlighter.
+
+Copyright (c) 2013 - 2017 Isaac Muse <isaacmuse@gmail.com>
+License: MIT
+
+Per view match state.
+"""
+
+from bisect import bisect_right
+
+BH_LOCATION_UNMATCHED = 0
+BH_LOCATION_OPEN = 1
+BH_LOCATION_CLOSE = 2
+
+view_states = {}
+
+
+class BracketLocations(object):
+    """
+    Locations of the highlighted brackets.
+
+    Pairs are stored as parallel arrays of opening regions, closing regions,
+    and icons.  Regions are stored as `(begin, end)` tuples.
+
+    An index of the regions sorted by their start is built on the first lookup
+    so the bracket under a point can be found with a bisect.
+    """
+
+    def __init__(self):
+        """Setup the locations."""
+
+        self.opens = []
+        self.closes = []
+        self.icons = []
+        self.unmatched = []
+        self.index = None
+
+    def __eq__(self, other):
+        """Compare locations."""
+
+        return (
+            isinstance(other, BracketLocations) and
+            self.opens == other.opens and
+            self.closes == other.closes and
+            self.icons == other.icons and
+            self.unmatched == other.unmatched
+        )
+
+    def add_pair(self, begin_region, end_region, icon):
+        """Add the regions of a bracket pair."""
+
+        self.opens.append(begin_region)
+        self.closes.append(end_region)
+        self.icons.append(icon)
+        self.index = None
+
+    def add_unmatched(self, region):
+        """Add the region of an unmatched bracket."""
+
+        self.unmatched.append(region)
+        self.index = None
+
+    def build_index(self):
+        """
+        Build the interval indexes.
+
+        Bracket regions and the spans of pairs are sorted by their start.  A running
+        maximum of their ends tells a backwards walk when no earlier entry can reach a point.
+        """
+
+        brackets = sorted(
+            [(begin, end, BH_LOCATION_UNMATCHED, i) for i, (begin, end) in enumerate(self.unmatched)] +
+            [(begin, end, BH_LOCATION_OPEN, i) for i, (begin, end) in enumerate(self.opens)] +
+            [(begin, end, BH_LOCATION_CLOSE, i) for i, (begin, end) in enumerate(self.closes)]
+        )
+        spans = sorted((region[0], self.closes[i][1], i) for i, region in enumerate(self.opens))
+        self.index = (
+            [b[0] for b in brackets], brackets, self.running_max(brackets),
+            [s[0] for s in spans], spans, self.running_max(spans)
+        )
+
+    @staticmethod
+    def running_max(entries):
+        """Get the running maximum of the entries' ends."""
+
+        maximum = []
+        last = -1
+        for entry in entries:
+            last = max(last, entry[1])
+            maximum.append(last)
+        return maximum
+
+    def get_bracket(self, pt):
+        """
+        Get the kind and pair index of the bracket at the point.
+
+        Unmatched brackets win over opening brackets, and opening brackets win over closing brackets.
+        """
+
+        if self.index is None:
+            self.build_index()
+        starts, brackets, maximum = self.index[:3]
+
+        found = None
+        i = bisect_right(starts, pt) - 1
+        while i >= 0 and maximum[i] >= pt:
+            begin, end, kind, index = brackets[i]
+            if end >= pt and (found is None or (kind, index) < found):
+                found = (kind, index)
+            i -= 1
+        return found
+
+    def is_unmatched(self, pt):
+        """Check if the point is on an unmatched bracket."""
+
+        found = self.get_bracket(pt)
+        return found is not None and found[0] == BH_LOCATION_UNMATCHED
+
+    def get_partner(self, pt):
+        """Get the region and icon of the bracket paired with the bracket at the point."""
+
+        found = self.get_bracket(pt)
+        if found is not None:
+            kind, index = found
+            if kind == BH_LOCATION_OPEN:
+                return self.closes[index], self.icons[index]
+            elif kind == BH_LOCATION_CLOSE:
+                return self.opens[index], self.icons[index]
+        return None, None
+
+    def get_between(self, pt):
+        """Get the regions and icon of the innermost pair the point is between."""
+
+        if self.index is None:
+            self.build_index()
+        starts, spans, maximum = self.index[3:]
+
+        i = bisect_right(starts, pt) - 1
+        while i >= 0 and maximum[i] >= pt:
+            begin, end, index = spans[i]
+            if end >= pt:
+                return self.opens[index], self.closes[index], self.icons[index]
+            i -= 1
+        return None
+
+
+class ViewState(object):
+    """Match state of a view."""
+
+    def __init__(self, view_id):
+        """Setup the state."""
+
+        self.view_id = view_id
+        self.busy = False
+        self.background = None
+        self.regions = None
+        self.locations = BracketLocations()
+        # Last update and the window its regions were clipped to, if any were
+        self.update = None
+        self.clip = None
+        # Whether the viewport is watched, and for how many checks it hasn't moved
+        self.watching = False
+        self.idle = 0
+
+
+def get_view_state(view_id):
+    """Get the state of the view, creating it if needed."""
+
+    state = view_states.get(view_id)
+    if state is None:
+        state = ViewState(view_id)
+        view_states[view_id] = state
+    return state
+
+
+def discard_view_state(view_id):
+    """Discard the state of a view."""
+
+    view_states.pop(view_id, None)
+
+
+def clear_view_states():
+    """Discard the state of all views."""
+
+    view_states.clear()
@@ -7,6 +7,7 @@ License: MIT
 import sublime
 import sublime_plugin
 from . import bh_wrapping
+from . import bh_state
 
 
 class SwapBrackets(bh_wrapping.WrapBrackets):
@@ -35,7 +36,7 @@ class SwapBracketsCommand(sublime_plugin.TextCommand):
         """Execute post wrap callback."""
 
         if self.view is not None:
-            if not self.view.settings().get("bracket_highlighter.busy", False):
+            if not bh_state.get_view_state(self.view.id()).busy:
                 callback()
             else:
                 sublime.set_timeout(lambda: self.finalize(callback), 100)
@@ -0,0 +1,523 @@
+"""
+BracketHighlighter.
+
+Copyright (c) 2013 - 2017 Isaac Muse <isaacmuse@gmail.com>
+License: MIT
+
+Incremental bracket token index.
+"""
+import re
+from backrefs import bre
+from bisect import bisect_left, bisect_right
+
+# Tokens are stored as tuples of:
+# `(begin, end, match_type, bracket_id, match_begin, match_end)`
+# where `begin` and `end` are the bracket's capture group and
+# `match_begin` and `match_end` are the span of the entire regex match.
+TOKEN_BEGIN = 0
+TOKEN_END = 1
+TOKEN_TYPE = 2
+TOKEN_ID = 3
+TOKEN_MATCH_BEGIN = 4
+TOKEN_MATCH_END = 5
+
+# How far we are willing to look for a line boundary when aligning scans.
+BH_LINE_LIMIT = 1024
+# How far past the scanned range a regex may look when resyncing.
+BH_SCAN_LOOKAHEAD = 1024
+# A bracket regex that is nothing but a single, literal, non-word character in a capture group.
+RE_LITERAL = re.compile(r'^\((?:\\([^\w\s])|([^\w\s\\.^$|?*+()\[\]{}]))\)$')
+# How much of the buffer literal brackets are gathered from at a time.
+BH_SCAN_CHUNK = 4096
+# A regex alternative that never matches.
+BH_NO_MATCH = r"([^\s\S])"
+
+# How many text changes of a buffer are remembered
+BH_CHANGE_SPAN_LIMIT = 32
+
+token_indexes = {}
+# Change count of each buffer when the text change listener last saw it change
+change_counts = {}
+# Spans of the recent text changes of each buffer, as
+# `(previous change count, change count, begin, old end, new end)`
+change_spans = {}
+
+
+def decode_match(m):
+    """Decode a bracket regex match into a token."""
+
+    g = m.lastindex
+    try:
+        start = m.start(g)
+        end = m.end(g)
+    except Exception:
+        return None
+
+    match_type = int(not bool(g % 2))
+    bracket_id = int((g / 2) - match_type)
+    return (start, end, match_type, bracket_id, m.start(0), m.end(0))
+
+
+def get_literal(regex):
+    """Get the character a bracket regex matches if it is a single literal character."""
+
+    m = RE_LITERAL.match(regex)
+    if m is None:
+        return None
+    return m.group(1) or m.group(2)
+
+
+class BracketScanner(object):
+    """
+    Scan a buffer for bracket tokens.
+
+    `regexes` are the opening and closing regexes of each rule in group order.
+    Rules that are a single literal character are found with a character class,
+    and a regex of only the remaining rules is used for the rules that need it.
+    Where both could match at the same point, the rule that comes first wins,
+    just as it would in the combined pattern.
+    """
+
+    def __init__(self, pattern, regexes):
+        """Setup the scanner."""
+
+        self.pattern = pattern
+        self.literals = {}
+        self.literal_groups = {}
+        complex_regexes = []
+        self.complex_groups = [0]
+        for group, regex in enumerate(regexes, 1):
+            char = get_literal(regex)
+            if char is None:
+                if regex != BH_NO_MATCH:
+                    complex_regexes.append(regex)
+                    self.complex_groups.append(group)
+            elif char not in self.literals:
+                match_type = int(not bool(group % 2))
+                bracket_id = int((group / 2) - match_type)
+                self.literals[char] = (match_type, bracket_id)
+                self.literal_groups[char] = group
+
+        self.literal_pattern = None
+        self.complex_pattern = None
+        if not self.literals:
+            return
+        self.literal_pattern = re.compile('[%s]' % re.escape(''.join(self.literals)))
+        if complex_regexes:
+            self.complex_pattern = bre.compile_search("(?:%s)" % '|'.join(complex_regexes), pattern.flags)
+
+    def find_literals(self, bfr, begin, end):
+        """Find the literal bracket tokens in the given range of the buffer."""
+
+        literals = self.literals
+        return [
+            (start, start + 1, match_type, bracket_id, start, start + 1)
+            for start, (match_type, bracket_id) in (
+                (m.start(), literals[m.group(0)]) for m in self.literal_pattern.finditer(bfr, begin, end)
+            )
+        ]
+
+    def decode_complex(self, m):
+        """Decode a match of the complex rules into a token of the combined pattern."""
+
+        g = m.lastindex
+        try:
+            start = m.start(g)
+            end = m.end(g)
+        except Exception:
+            return None
+
+        group = self.complex_groups[g]
+        match_type = int(not bool(group % 2))
+        bracket_id = int((group / 2) - match_type)
+        return (start, end, match_type, bracket_id, m.start(0), m.end(0))
+
+    def finditer(self, bfr, begin, end):
+        """Find the bracket tokens in the given range of the buffer."""
+
+        if self.literal_pattern is None:
+            for m in self.pattern.finditer(bfr, begin, end):
+                token = decode_match(m)
+                if token is not None:
+                    yield token
+            return
+
+        complex_search = self.complex_pattern.search if self.complex_pattern is not None else None
+        pt = begin
+        while pt < end:
+            cmplx = complex_search(bfr, pt, end) if complex_search is not None else None
+            limit = cmplx.start() if cmplx is not None else end
+
+            # Literal brackets up to the next complex match are found in chunks,
+            # so a scan that is stopped early doesn't do more work than it needs to.
+            while pt < limit:
+                stop = min(limit, pt + BH_SCAN_CHUNK)
+                yield from self.find_literals(bfr, pt, stop)
+                pt = stop
+
+            if cmplx is None:
+                break
+
+            # A literal at the same point wins if its rule comes first.
+            group = self.literal_groups.get(bfr[limit:limit + 1])
+            if group is not None and group < self.complex_groups[cmplx.lastindex or 0]:
+                yield from self.find_literals(bfr, limit, limit + 1)
+                pt = limit + 1
+                continue
+
+            token = self.decode_complex(cmplx)
+            if token is not None:
+                yield token
+            pt = cmplx.end() if cmplx.end() > limit else limit + 1
+
+
+def line_start(bfr, pt):
+    """Get the start of the line containing the point, but don't look back further than the line limit."""
+
+    limit = max(0, pt - BH_LINE_LIMIT)
+    return max(limit, bfr.rfind('\n', limit, pt) + 1)
+
+
+def line_end(bfr, pt):
+    """Get the start of the line after the point, but don't look ahead further than the line limit."""
+
+    limit = min(len(bfr), pt + BH_LINE_LIMIT)
+    end = bfr.find('\n', pt, limit)
+    return limit if end == -1 else end + 1
+
+
+class TokenIndex(object):
+    """
+    Bracket tokens found in a buffer.
+
+    Only the region of the buffer that has been requested is scanned.
+    As the buffer is edited, tokens are shifted, and only the dirty lines are rescanned.
+    """
+
+    def __init__(self, buffer_id, scanner):
+        """Setup the index."""
+
+        self.buffer_id = buffer_id
+        self.scanner = scanner
+        self.pattern = scanner.pattern
+        self.reset(None)
+
+    def reset(self, change_count):
+        """Drop all tokens."""
+
+        self.change_count = change_count
+        self.tokens = []
+        self.starts = []
+        self.begin = 0
+        self.end = 0
+        self.dirty = None
+
+    def copy(self):
+        """Copy the index so it can be extended without changing this one."""
+
+        index = TokenIndex(self.buffer_id, self.scanner)
+        index.change_count = self.change_count
+        index.tokens = list(self.tokens)
+        index.starts = list(self.starts)
+        index.begin = self.begin
+        index.end = self.end
+        index.dirty = self.dirty
+        return index
+
+    def is_compatible(self, scanner):
+        """Check if the index was built with an equivalent pattern."""
+
+        pattern = scanner.pattern
+        return pattern is self.pattern or (
+            pattern.pattern == self.pattern.pattern and pattern.flags == self.pattern.flags
+        )
+
+    def rescan(self, bfr, begin, end):
+        """
+        Rescan a range of the buffer and splice the tokens into the index.
+
+        Scanning continues past the range until the new tokens line up
+        with the tokens that are already in the index.
+        """
+
+        tokens = self.tokens
+        starts = self.starts
+        index = bisect_left(starts, begin)
+        if index and tokens[index - 1][TOKEN_MATCH_END] > begin:
+            index -= 1
+            begin = tokens[index][TOKEN_MATCH_BEGIN]
+        if begin < self.begin:
+            self.begin = begin
+
+        count = len(tokens)
+        stop = index
+        found = []
+        for token in self.scanner.finditer(bfr, begin, min(len(bfr), max(end, self.end) + BH_SCAN_LOOKAHEAD)):
+            match_begin = token[TOKEN_MATCH_BEGIN]
+            if match_begin >= end:
+                # Past the dirty range, see if we are back in sync with the old tokens.
+                while stop < count and starts[stop] < match_begin:
+                    stop += 1
+                if (
+                    stop < count and starts[stop] == match_begin and
+                    tokens[stop][TOKEN_MATCH_END] == token[TOKEN_MATCH_END]
+                ):
+                    break
+                if match_begin >= self.end:
+                    break
+            found.append(token)
+        else:
+            stop = count
+
+        if found:
+            last = found[-1][TOKEN_MATCH_END]
+            while stop < count and starts[stop] < last:
+                stop += 1
+            if last > self.end:
+                self.end = last
+
+        tokens[index:stop] = found
+        starts[index:stop] = [t[TOKEN_MATCH_BEGIN] for t in found]
+
+    def extend(self, bfr, begin, end):
+        """Make sure the given range of the buffer has been scanned."""
+
+        if self.dirty is not None:
+            dirty_begin, dirty_end = self.dirty
+            self.dirty = None
+            dirty_begin = max(self.begin, dirty_begin)
+            dirty_end = min(self.end, dirty_end)
+            if dirty_begin <= dirty_end:
+                # Lookbehinds can see the previous line, so include it as well.
+                self.rescan(
+                    bfr,
+                    line_start(bfr, max(0, line_start(bfr, dirty_begin) - 1)),
+                    line_end(bfr, dirty_end)
+                )
+
+        if self.begin == self.end or end < self.begin - (end - begin) or begin > self.end + (end - begin):
+            # Nothing scanned yet, or the requested range is too far away to bridge the gap.
+            self.tokens = []
+            self.starts = []
+            self.begin = line_start(bfr, begin)
+            self.end = line_end(bfr, end)
+            self.rescan(bfr, self.begin, self.end)
+            return
+
+        if begin < self.begin:
+            old_begin = self.begin
+            self.begin = line_start(bfr, begin)
+            self.rescan(bfr, self.begin, old_begin)
+        if end > self.end:
+            old_end = self.end
+            self.end = line_end(bfr, end)
+            self.rescan(bfr, old_end, self.end)
+
+    def get_tokens(self, bfr, change_count, begin, end, limit=None):
+        """
+        Get all tokens whose match is within the given range.
+
+        If a limit is given, tokens whose match starts within the range
+        and ends before the limit are returned instead.
+        """
+
+        if change_count != self.change_count:
+            self.reset(change_count)
+        self.extend(bfr, begin, end)
+
+        tokens = self.tokens
+        index = bisect_left(self.starts, begin)
+        last = len(tokens)
+        found = []
+        while index < last:
+            token = tokens[index]
+            if token[TOKEN_MATCH_BEGIN] >= end and (limit is not None or token[TOKEN_MATCH_END] > end):
+                break
+            if token[TOKEN_MATCH_END] <= (end if limit is None else limit):
+                found.append(token)
+            index += 1
+        return found
+
+    def touches(self, bfr, change_count, begin, end):
+        """Check if the match of any token overlaps or touches the given range."""
+
+        if change_count != self.change_count:
+            self.reset(change_count)
+        self.extend(bfr, begin, end)
+
+        # Matches don't overlap, so only the last match to start before the end can reach the beginning.
+        index = bisect_right(self.starts, end) - 1
+        return index >= 0 and self.tokens[index][TOKEN_MATCH_END] >= begin
+
+    def apply_change(self, begin, end, size):
+        """
+        Update the index to reflect a change to the buffer.
+
+        `begin` and `end` are the replaced region and `size` is the length of the new text.
+        Tokens touching the change are removed and the area is marked dirty, later tokens are shifted.
+        """
+
+        if self.begin == self.end or begin > self.end + BH_SCAN_LOOKAHEAD:
+            # Nothing scanned, or the change is well past the scanned range.
+            return
+
+        delta = size - (end - begin)
+        tokens = self.tokens
+        starts = self.starts
+
+        if end + BH_SCAN_LOOKAHEAD < self.begin:
+            # The change is well before the scanned range, so just shift everything.
+            self.tokens = [
+                (t[0] + delta, t[1] + delta, t[2], t[3], t[4] + delta, t[5] + delta) for t in tokens
+            ]
+            self.starts = [s + delta for s in starts]
+            self.begin += delta
+            self.end += delta
+            if self.dirty is not None:
+                self.dirty = (self.dirty[0] + delta, self.dirty[1] + delta)
+            return
+
+        if begin < self.begin or end > self.end:
+            # Changes at the edges can affect lookarounds of the edge tokens, so start over.
+            self.reset(self.change_count)
+            return
+
+        # Remove tokens that touch the change
+        first = bisect_left(starts, begin)
+        while first and tokens[first - 1][TOKEN_MATCH_END] >= begin:
+            first -= 1
+        last = first
+        count = len(tokens)
+        while last < count and starts[last] <= end:
+            last += 1
+        dirty_begin = begin
+        dirty_end = begin + size
+        if first < last:
+            dirty_begin = min(dirty_begin, tokens[first][TOKEN_MATCH_BEGIN])
+            dirty_end = max(dirty_end, tokens[last - 1][TOKEN_MATCH_END] + delta)
+
+        # Shift the rest
+        tail = [
+            (t[0] + delta, t[1] + delta, t[2], t[3], t[4] + delta, t[5] + delta) for t in tokens[last:]
+        ]
+        self.tokens = tokens[:first] + tail
+        self.starts = starts[:first] + [t[TOKEN_MATCH_BEGIN] for t in tail]
+
+        self.end += delta
+
+        # Track the dirty area so it is rescanned on the next request
+        if self.dirty is not None:
+            old_begin, old_end = self.dirty
+            old_begin = old_begin if old_begin < begin else (old_begin + delta if old_begin > end else begin)
+            old_end = old_end if old_end < begin else (old_end + delta if old_end > end else begin + size)
+            dirty_begin = min(dirty_begin, old_begin)
+            dirty_end = max(dirty_end, old_end)
+        self.dirty = (dirty_begin, dirty_end)
+
+
+def get_token_index(buffer_id, scanner, indexes=None):
+    """
+    Get the token index for the buffer, creating a new one if needed.
+
+    Indexes are kept in `token_indexes` unless another set of indexes is given.
+    """
+
+    if indexes is None:
+        indexes = token_indexes
+    index = indexes.get(buffer_id)
+    if index is None or not index.is_compatible(scanner):
+        index = TokenIndex(buffer_id, scanner)
+        indexes[buffer_id] = index
+    return index
+
+
+def copy_token_indexes(buffer_id):
+    """
+    Copy the buffer's token index into a new set of indexes.
+
+    Matches off the main thread work from a copy, so they never change
+    the index that text changes are applied to.
+    """
+
+    index = token_indexes.get(buffer_id)
+    return {buffer_id: index.copy()} if index is not None else {}
+
+
+def merge_span(span, begin, end, size):
+    """
+    Merge a change into the span of the buffer changed so far.
+
+    Spans are `(begin, old end, new end)`, and the change is given in terms of the text after the span's changes.
+    """
+
+    if span is None:
+        return (begin, end, begin + size)
+    span_begin, old_end, new_end = span
+    stop = max(new_end, end)
+    return (min(span_begin, begin), stop + old_end - new_end, stop + size - (end - begin))
+
+
+def get_change_span(buffer_id, since, until):
+    """
+    Get the span of the buffer changed between two change counts as `(begin, old end, new end)`.
+
+    `None` is returned if not all the changes between them are known.
+    """
+
+    span = None
+    count = since
+    for previous, change_count, begin, old_end, new_end in change_spans.get(buffer_id, []):
+        if previous != count:
+            continue
+        span = merge_span(span, begin, old_end, new_end - begin)
+        count = change_count
+        if count == until:
+            return span
+    return None
+
+
+def apply_changes(buffer_id, changes, change_count):
+    """
+    Apply text changes from a text change listener to the buffer's index, and remember the span they changed.
+
+    Changes can only be applied to an index that was at the change count the buffer
+    was at before them.  Any other index is out of step with the changes and is reset.
+    """
+
+    previous = change_counts.get(buffer_id)
+    change_counts[buffer_id] = change_count
+
+    span = None
+    for change in changes:
+        span = merge_span(span, change.a.pt, change.b.pt, len(change.str))
+    if span is not None:
+        spans = change_spans.get(buffer_id, [])[1 - BH_CHANGE_SPAN_LIMIT:]
+        spans.append((previous, change_count) + span)
+        change_spans[buffer_id] = spans
+
+    index = token_indexes.get(buffer_id)
+    if index is None:
+        return
+
+    if index.change_count is not None and index.change_count == previous:
+        for change in changes:
+            index.apply_change(change.a.pt, change.b.pt, len(change.str))
+        index.change_count = change_count
+    else:
+        index.reset(change_count)
+
+
+def discard_token_index(buffer_id):
+    """Discard the token index of a buffer."""
+
+    token_indexes.pop(buffer_id, None)
+    change_counts.pop(buffer_id, None)
+    change_spans.pop(buffer_id, None)
+
+
+def clear_token_indexes():
+    """Discard all token indexes."""
+
+    token_indexes.clear()
+    change_counts.clear()
+    change_spans.clear()
@@ -0,0 +1,67 @@
+"""Test the tag tree."""
+import unittest
+
+try:
+    import sublime
+    from BracketHighlighter.bh_modules import tags
+except ImportError:
+    sublime = None
+
+
+@unittest.skipIf(sublime is None, "Requires Sublime Text")
+class TestTagTree(unittest.TestCase):
+    """Test that updating the tag tree gives the same tree as building it again."""
+
+    def setUp(self):
+        """Open a view to edit."""
+
+        self.view = sublime.active_window().new_file()
+        self.view.set_scratch(True)
+        self.view.settings().set('auto_match_enabled', False)
+        self.view.assign_syntax('Packages/HTML/HTML.sublime-syntax')
+        self.mode_settings = tags.get_tag_mode_settings('html')
+
+    def tearDown(self):
+        """Close the view."""
+
+        self.view.close()
+
+    def get_tree(self, tree=None):
+        """Update the tree, or build a new one, for the current text of the view."""
+
+        if tree is None:
+            tree = tags.TagTree(self.view.buffer_id(), self.mode_settings)
+        bfr = self.view.substr(sublime.Region(0, self.view.size()))
+        tree.update(self.view, bfr, self.view.change_count())
+        return tree
+
+    def replace(self, begin, end, text):
+        """Replace a part of the view's text."""
+
+        self.view.sel().clear()
+        self.view.sel().add(sublime.Region(begin, end))
+        self.view.run_command('insert', {'characters': text})
+
+    def assert_same_tree(self, tree, fresh):
+        """Check that two trees have the same tags and elements."""
+
+        self.assertEqual(tree.tags, fresh.tags)
+        self.assertEqual(tree.lefts, fresh.lefts)
+        self.assertEqual(tree.rights, fresh.rights)
+        self.assertEqual(tree.parents, fresh.parents)
+        self.assertEqual(tree.pops, fresh.pops)
+        self.assertEqual(tree.closed, fresh.closed)
+        for index in range(len(tree.lefts)):
+            self.assertEqual(tree.get_children(index), fresh.get_children(index))
+
+    def test_swallowed_tag(self):
+        """Test an edit that completes a tag which swallows a paired tag after the edit."""
+
+        self.view.run_command(
+            'append',
+            {'characters': '<li><<<br>="<b class="<i>">x"> ><</p>x<b class<<i>"> </a><bclass="<i>">'}
+        )
+        tree = self.get_tree()
+        self.replace(23, 29, '<img/> ')
+        self.get_tree(tree)
+        self.assert_same_tree(tree, self.get_tree())